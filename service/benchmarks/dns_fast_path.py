@@ -0,0 +1,105 @@
+# CPU time per answered query with and without the wire fast path.
+#
+# Runs the DNS proxy on a local port with an upstream that answers right
+# away, warms up the answer cache and then sends the same queries again, so
+# every measured query is a cache hit.
+#
+#   python benchmarks/dns_fast_path.py [queries]
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import time
+
+os.environ['CONFIG'] = os.path.join(tempfile.mkdtemp(), 'config.yaml')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from aiodnsresolver import (  # noqa: E402
+    QUESTION,
+    TYPES,
+    IPv4AddressExpiresAt,
+    Message,
+    QuestionRecord,
+    pack,
+)
+
+from config import get_config  # noqa: E402
+from dns_proxy import DnsProxy  # noqa: E402
+
+NAMES = 100
+BATCH = 50
+
+
+def request(qid: int, name: bytes) -> bytes:
+    return pack(Message(
+        qid=qid, qr=QUESTION, opcode=0, aa=0, tc=0, rd=1, ra=0, z=0, rcode=0,
+        qd=(QuestionRecord(name, TYPES.A, 1),), an=(), ns=(), ar=()))
+
+
+async def run(queries: int, fast_path: bool) -> float:
+    get_config().networking.wire_fast_path = fast_path
+    loop = asyncio.get_running_loop()
+
+    async def resolve(name, qtype, get_logger_adapter=None):
+        return (IPv4AddressExpiresAt('10.0.0.1', loop.time() + 3600),
+                IPv4AddressExpiresAt('10.0.0.2', loop.time() + 3600))
+
+    async def clear_cache():
+        pass
+
+    async def resolved_callback(addr, domain, ips):
+        pass
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.setblocking(False)
+    server.bind(('127.0.0.1', 0))
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.setblocking(False)
+    client.connect(server.getsockname())
+
+    start = DnsProxy(get_resolver=lambda: (resolve, clear_cache),
+                     get_socket=lambda: server, num_workers=BATCH,
+                     resolved_callback=resolved_callback)
+    proxy_task = await start()
+
+    requests = [request(i, b'host%d.example.com' % (i % NAMES))
+                for i in range(queries)]
+
+    async def exchange(batch):
+        for data in batch:
+            client.send(data)
+        for _ in batch:
+            await loop.sock_recv(client, 512)
+
+    await exchange(requests[:NAMES])
+    cpu_start = time.process_time()
+    for i in range(0, queries, BATCH):
+        await exchange(requests[i:i + BATCH])
+    cpu = time.process_time() - cpu_start
+
+    proxy_task.cancel()
+    try:
+        await proxy_task
+    except asyncio.CancelledError:
+        pass
+    client.close()
+    return cpu / queries
+
+
+async def main():
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    get_config().profiling.sample_rate = 0
+    # Rate limits would kick in for a single client sending this fast
+    get_config().networking.dns_limits.client_queries_per_second = 10 ** 9
+    get_config().networking.dns_limits.client_burst = 10 ** 9
+
+    full = await run(queries, fast_path=False)
+    fast = await run(queries, fast_path=True)
+    print(f'full parse and pack: {full * 1e6:.1f} us CPU per query')
+    print(f'wire fast path:      {fast * 1e6:.1f} us CPU per query')
+    print(f'reduction:           {(1 - fast / full) * 100:.0f}%')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
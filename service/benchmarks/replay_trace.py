@@ -0,0 +1,200 @@
+# Replays a query trace captured with POST /api/trace/start through the DNS
+# proxy and the routing code, with a stub upstream and a stub `ip route`.
+#
+#   python benchmarks/replay_trace.py queries.trace [--speed 10]
+#       [--config config.yaml] [--upstream-ms 20] [--route-ms 5]
+#
+# --speed 1 replays at the recorded pace, larger values faster, 0 as fast as
+# --max-in-flight allows. Manual domain lists are loaded from the files next
+# to the config; external lists are not downloaded.
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import zlib
+from collections import Counter
+from ipaddress import IPv4Address
+
+parser = argparse.ArgumentParser()
+parser.add_argument('trace')
+parser.add_argument('--config')
+parser.add_argument('--speed', type=float, default=1)
+parser.add_argument('--max-in-flight', type=int, default=100)
+parser.add_argument('--upstream-ms', type=float, default=20)
+parser.add_argument('--upstream-ttl', type=int, default=300)
+parser.add_argument('--route-ms', type=float, default=5)
+parser.add_argument('--timeout', type=float, default=2)
+args = parser.parse_args()
+
+trace_file = os.path.abspath(args.trace)
+config_file = os.path.abspath(args.config) if args.config else \
+    os.path.join(tempfile.mkdtemp(), 'config.yaml')
+os.environ['CONFIG'] = config_file
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.chdir(os.path.dirname(config_file))
+
+from aiodnsresolver import (  # noqa: E402
+    QUESTION,
+    IPv4AddressExpiresAt,
+    Message,
+    QuestionRecord,
+    pack,
+)
+
+import ip_route  # noqa: E402
+from answer_cache import answer_cache  # noqa: E402
+from config import get_config  # noqa: E402
+from dns_proxy import DnsProxy, stats as dns_stats  # noqa: E402
+from dns_wire import HEADER  # noqa: E402
+from domain_lists import (  # noqa: E402
+    get_match_cache_stats,
+    init_manual_domain_lists,
+)
+from event_logger import event_logger  # noqa: E402
+from main import on_resolve  # noqa: E402
+from query_trace import read_trace  # noqa: E402
+from route_pipeline import route_pipeline  # noqa: E402
+
+route_ops = Counter()
+route_commands = 0
+upstream_queries = 0
+
+
+async def stub_exec_command(*command, input=None):
+    global route_commands
+    route_commands += 1
+    if input is not None:
+        route_ops.update(line.split()[1] for line in input.splitlines())
+    else:
+        route_ops[command[len(get_config().ip_route_command.split())]] += 1
+    await asyncio.sleep(args.route_ms / 1000)
+    return ''
+
+
+def percentile(values: list[float], p: float) -> float:
+    return statistics.quantiles(values, n=100)[p - 1] \
+        if len(values) > 1 else (values or [0])[0]
+
+
+async def main():
+    ip_route.exec_command = stub_exec_command
+    config = get_config()
+    config.profiling.sample_rate = 0
+    # All replayed queries come from one address
+    config.networking.dns_limits.client_queries_per_second = 10 ** 9
+    config.networking.dns_limits.client_burst = 10 ** 9
+
+    loop = asyncio.get_running_loop()
+
+    async def resolve(name, qtype, get_logger_adapter=None):
+        global upstream_queries
+        upstream_queries += 1
+        await asyncio.sleep(args.upstream_ms / 1000)
+        ip = IPv4Address(0x0A000000 | zlib.crc32(name.encode()) & 0xFFFFFF)
+        return (IPv4AddressExpiresAt(ip.packed,
+                                     loop.time() + args.upstream_ttl),)
+
+    async def clear_cache():
+        pass
+
+    async def drain_events():
+        while True:
+            await event_logger.get_next_event()
+
+    event_logger.setup()
+    drain_task = asyncio.create_task(drain_events())
+    await init_manual_domain_lists()
+    await ip_route.sync_ip_route_cache()
+    route_pipeline.start()
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.setblocking(False)
+    server.bind(('127.0.0.1', 0))
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.setblocking(False)
+    # Responses dropped here would be counted against the proxy
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    client.connect(server.getsockname())
+
+    start = DnsProxy(get_resolver=lambda: (resolve, clear_cache),
+                     get_socket=lambda: server,
+                     resolved_callback=on_resolve)
+    proxy_task = await start()
+
+    in_flight = asyncio.Semaphore(args.max_in_flight)
+    sent_at = {}
+    latencies = []
+    lost = 0
+
+    async def receive():
+        while True:
+            data = await loop.sock_recv(client, 512)
+            qid = HEADER.unpack_from(data)[0]
+            sent = sent_at.pop(qid, None)
+            if sent is not None:
+                latencies.append(loop.time() - sent)
+                in_flight.release()
+
+    async def expire():
+        nonlocal lost
+        while True:
+            await asyncio.sleep(0.1)
+            expired = [qid for qid, sent in sent_at.items()
+                       if loop.time() - sent > args.timeout]
+            for qid in expired:
+                del sent_at[qid]
+                in_flight.release()
+            lost += len(expired)
+
+    receive_task = asyncio.create_task(receive())
+    expire_task = asyncio.create_task(expire())
+
+    queries = 0
+    replay_start = loop.time()
+    for i, query in enumerate(read_trace(trace_file)):
+        if args.speed:
+            delay = replay_start + query.offset / args.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await in_flight.acquire()
+        qid = i % 65536
+        sent_at[qid] = loop.time()
+        client.send(pack(Message(
+            qid=qid, qr=QUESTION, opcode=0, aa=0, tc=0, rd=1, ra=0, z=0,
+            rcode=0, qd=(QuestionRecord(query.name, query.qtype, 1),),
+            an=(), ns=(), ar=())))
+        queries += 1
+
+    deadline = loop.time() + args.timeout
+    while sent_at and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    duration = loop.time() - replay_start
+    lost += len(sent_at)
+
+    tasks = (receive_task, expire_task, drain_task, proxy_task)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    print(f'queries:          {queries} in {duration:.1f}s '
+          f'({queries / duration:.0f}/s)')
+    print(f'answered:         {len(latencies)}, lost: {lost}')
+    if latencies_ms:
+        print(f'latency ms:       p50 {percentile(latencies_ms, 50):.2f}  '
+              f'p90 {percentile(latencies_ms, 90):.2f}  '
+              f'p99 {percentile(latencies_ms, 99):.2f}  '
+              f'max {latencies_ms[-1]:.2f}')
+    print(f'upstream queries: {upstream_queries}')
+    print(f'route commands:   {route_commands}, operations: '
+          f'{dict(route_ops)}')
+    print(f'dns:              {dns_stats}')
+    print(f'answer cache:     {answer_cache.get_stats()}')
+    print(f'match cache:      {get_match_cache_stats()}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+import time
+from typing import Optional
+
+from aiodnsresolver import IPv4AddressExpiresAt
+
+from config import get_config
+from dns_wire import WireAnswer
+
+
+class AnswerCache:
+    _entries: dict[tuple[str, int], tuple[IPv4AddressExpiresAt, ...]]
+    # Packed answers by the name as it is in requests, for the fast path
+    _wire_entries: dict[tuple[bytes, int], WireAnswer]
+
+    def __init__(self):
+        self._entries = {}
+        self._wire_entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.wire_hits = 0
+
+    def get(self, name: str, qtype: int, now: float) \
+            -> Optional[tuple[IPv4AddressExpiresAt, ...]]:
+        key = (name, qtype)
+        answers = self._entries.get(key)
+        if answers is not None and \
+                min(answer.expires_at for answer in answers) <= now:
+            del self._entries[key]
+            answers = None
+        if answers is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answers
+
+    def put(self, name: str, qtype: int,
+            answers: tuple[IPv4AddressExpiresAt, ...]):
+        if not answers:
+            return
+        key = (name, qtype)
+        self._entries.pop(key, None)
+        self._entries[key] = answers
+        if len(self._entries) > get_config().networking.dns_cache_size:
+            del self._entries[next(iter(self._entries))]
+
+    def get_wire(self, name: bytes, qtype: int, now: float) \
+            -> Optional[WireAnswer]:
+        key = (name, qtype)
+        answer = self._wire_entries.get(key)
+        if answer is None:
+            return None
+        if answer.expires_at <= now:
+            del self._wire_entries[key]
+            return None
+        self.wire_hits += 1
+        return answer
+
+    def put_wire(self, name: bytes, qtype: int, answer: WireAnswer):
+        key = (name, qtype)
+        self._wire_entries.pop(key, None)
+        self._wire_entries[key] = answer
+        if len(self._wire_entries) > get_config().networking.dns_cache_size:
+            del self._wire_entries[next(iter(self._wire_entries))]
+
+    def clear(self):
+        self._entries.clear()
+        self._wire_entries.clear()
+
+    def dump(self, now: float) -> list:
+        # expires_at is loop time, which does not survive a restart, so the
+        # snapshot stores wall clock expiry instead
+        wall_offset = time.time() - now
+        return [
+            [name, qtype, [[str(answer), answer.expires_at + wall_offset]
+                           for answer in answers]]
+            for (name, qtype), answers in self._entries.items()
+            if min(answer.expires_at for answer in answers) > now
+        ]
+
+    def load(self, entries: list, now: float):
+        wall_offset = time.time() - now
+        for name, qtype, answers in entries:
+            answers = tuple(
+                IPv4AddressExpiresAt(ip, expires_at - wall_offset)
+                for ip, expires_at in answers)
+            if min(answer.expires_at for answer in answers) > now:
+                self.put(name, qtype, answers)
+
+    def get_stats(self):
+        # A query missed by the fast path is looked up again with get, so
+        # every query is counted once
+        hits = self.wire_hits + self.hits
+        total = hits + self.misses
+        return {
+            'size': len(self._entries),
+            'wire_size': len(self._wire_entries),
+            'wire_hits': self.wire_hits,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': hits / total if total else 0.0,
+        }
+
+
+answer_cache = AnswerCache()
@@ -13,13 +13,66 @@ class InterfaceConfig(BaseModel):
         return hash(self.name + self.gateway_ip)
 
     def __eq__(self, other):
+        if not isinstance(other, InterfaceConfig):
+            return NotImplemented
         return self.name == other.name and self.gateway_ip == other.gateway_ip
 
 
+class TunnelGroup(BaseModel):
+    name: str
+    tunnels: list[str]
+
+
+class ProbeConfig(BaseModel):
+    target: str = '1.1.1.1'
+    interval_seconds: float = 10
+    timeout_seconds: float = 2
+    failures_before_down: int = 3
+    switch_margin_ms: float = 20
+
+
+class DnsLimitsConfig(BaseModel):
+    client_queries_per_second: float = 50
+    client_burst: int = 200
+    max_tracked_clients: int = 10000
+    # Requests are answered with SERVFAIL right away once the queue to the
+    # workers is this full (at most 1), instead of blocking the receive loop
+    shed_queue_fraction: float = 0.9
+    # 'refused' to answer rate limited requests, 'drop' to ignore them
+    rate_limited_response: str = 'refused'
+
+
+class UpstreamConfig(BaseModel):
+    # 'udp' resolves through the servers in /etc/resolv.conf, 'dot' and
+    # 'doh' through pooled encrypted connections that are kept open
+    transport: str = 'udp'
+    # host or host:port, port 853 by default
+    dot_servers: list[str] = ['1.1.1.1']
+    tls_server_name: Optional[str] = 'cloudflare-dns.com'
+    doh_url: str = 'https://cloudflare-dns.com/dns-query'
+    # Connections per DoT server, or the DoH connection limit
+    pool_size: int = 2
+    timeout_seconds: float = 3
+    max_backoff_seconds: float = 30
+    tls_ca_file: Optional[str] = None
+    tls_verify: bool = True
+
+
 class NetworkingConfig(BaseModel):
     tunnels: list[InterfaceConfig] = [InterfaceConfig(name='tun0',
                                                       gateway_ip='1.2.3.4')]
     dns_port: int = 5553
+    dns_cache_size: int = 10000
+    # Answer repeated A queries from packed answers without a full parse
+    # and pack of the DNS messages
+    wire_fast_path: bool = True
+    route_wait_ms: float = 500
+    dns_limits: DnsLimitsConfig = DnsLimitsConfig()
+    # A domain list interface may name a group instead of a single tunnel.
+    # Its routes go via the fastest healthy tunnel of the group
+    tunnel_groups: list[TunnelGroup] = []
+    probe: ProbeConfig = ProbeConfig()
+    upstream: UpstreamConfig = UpstreamConfig()
 
 
 class DomainList(BaseModel):
@@ -38,6 +91,99 @@ class ExternalDomainList(DomainList):
     update_interval_hours: int
 
 
+class ExternalIpList(BaseModel):
+    name: str
+    interface: str
+    url: str
+    update_interval_hours: int
+    # Install the list's networks as routes up front instead of adding a
+    # route for each resolved IP
+    preinstall_routes: bool = False
+
+
+class RouteAggregationConfig(BaseModel):
+    enabled: bool = False
+    prefix_length: int = 24
+    # Share of a prefix's addresses routed through one tunnel at which
+    # their host routes are replaced by a route for the whole prefix
+    min_density: float = 0.0625
+    # IPs resolved for the default route keep their prefix from being
+    # aggregated for this long after they were last resolved
+    default_ip_memory_minutes: float = 60
+
+
+class StaticAnswersConfig(BaseModel):
+    # Names answered without asking upstream, e.g. {'nas.lan': ['10.0.0.2']}
+    records: dict[str, list[str]] = {}
+    # Files in /etc/hosts format with more records
+    hosts_files: list[str] = []
+    # Files with names to block, one per line or in hosts format
+    blocklist_files: list[str] = []
+    # 'nxdomain' to answer blocked names with NXDOMAIN, 'zero' with 0.0.0.0
+    blocklist_mode: str = 'nxdomain'
+    ttl_seconds: int = 300
+
+
+class SchedulerConfig(BaseModel):
+    # Intervals of periodic tasks vary by up to this share, so tasks
+    # started together drift apart
+    jitter_fraction: float = 0.1
+    # First runs are also delayed by up to jitter_fraction of the interval,
+    # but by no more than this, so tasks added together do not all start at
+    # once and lists are still downloaded soon after startup
+    first_run_spread_seconds: float = 30
+    # A failed task is retried after this delay, doubled on each further
+    # failure up to its normal interval
+    retry_seconds: float = 30
+
+
+class TrafficStatsConfig(BaseModel):
+    # Counts are kept per bucket, the oldest bucket is dropped when a new
+    # one starts, so the longest window is bucket_seconds * buckets
+    bucket_seconds: int = 60
+    buckets: int = 60
+    # Heavy hitters tracked per bucket for top domains and clients
+    top_capacity: int = 200
+    sketch_width: int = 1024
+    sketch_depth: int = 4
+
+
+class TraceCaptureConfig(BaseModel):
+    file: str = 'queries.trace'
+    # Capture stops by itself after this many queries
+    max_queries: int = 1000000
+
+
+class ReplicationConfig(BaseModel):
+    # 'active' streams manual list edits and routing decisions to standby
+    # nodes, 'standby' follows the active node at peer_host
+    role: str = 'off'
+    # Standby nodes on other hosts need a reachable address here, which is
+    # only accepted together with a token
+    listen_host: str = '127.0.0.1'
+    port: int = 5554
+    peer_host: Optional[str] = None
+    # Shared secret both nodes must have, if set
+    token: Optional[str] = None
+    # Changes kept for standby nodes to catch up after a reconnect, they
+    # get a full snapshot if they missed more
+    log_size: int = 10000
+    max_backoff_seconds: float = 30
+
+
+class ProfilingConfig(BaseModel):
+    sample_rate: float = 0.05
+    slow_query_ms: float = 50
+    slow_query_log_size: int = 200
+    cpu_sample_interval_ms: float = 5
+
+
+class StateSnapshotConfig(BaseModel):
+    file: str = 'state.json.gz'
+    interval_minutes: float = 5
+    max_age_hours: float = 24
+
+
 class Config(BaseModel):
     networking: NetworkingConfig = NetworkingConfig()
     external_domain_lists: list[ExternalDomainList] = [
@@ -52,9 +198,19 @@ class Config(BaseModel):
         DomainList(name='force_default', interface='force_default'),
         DomainList(name='vpn', interface='tun0')
     ]
+    external_ip_lists: list[ExternalIpList] = []
+    match_cache_size: int = 10000
     ip_route_command: str = 'sudo ip route'
+    route_aggregation: RouteAggregationConfig = RouteAggregationConfig()
+    static_answers: StaticAnswersConfig = StaticAnswersConfig()
+    scheduler: SchedulerConfig = SchedulerConfig()
+    traffic_stats: TrafficStatsConfig = TrafficStatsConfig()
     loggers: dict[str, str] = {'freeroute': 'INFO', 'dnsrewriteproxy': 'ERROR'}
     api_port: int = 8080
+    profiling: ProfilingConfig = ProfilingConfig()
+    state_snapshot: StateSnapshotConfig = StateSnapshotConfig()
+    trace_capture: TraceCaptureConfig = TraceCaptureConfig()
+    replication: ReplicationConfig = ReplicationConfig()
 
 
 __config: Optional[Config] = None
@@ -72,6 +228,12 @@ def write_config():
         yaml.dump(__config.dict(), f)
 
 
+def reload_config() -> Config:
+    global __config
+    __config = load_config() or __config
+    return get_config()
+
+
 def get_config() -> Config:
     global __config
     __config = __config or load_config()
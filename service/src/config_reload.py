@@ -0,0 +1,73 @@
+import asyncio
+from typing import Optional
+
+import yaml
+from pydantic import ValidationError
+
+from config import get_config, reload_config
+from domain_lists import reload_domain_lists
+from domain_router import update_interfaces, re_route_all_domains
+from ip_lists import reload_ip_lists
+from ip_route import reload_tunnels
+from logger import logger, init_logging
+from replication import start_replication, stop_replication
+from static_answers import static_answers
+
+_reload_lock: Optional[asyncio.Lock] = None
+
+
+async def reload() -> list[str]:
+    global _reload_lock
+    _reload_lock = _reload_lock or asyncio.Lock()
+    async with _reload_lock:
+        old = get_config()
+        try:
+            new = reload_config()
+        except (ValidationError, yaml.YAMLError, OSError):
+            logger.exception('Failed to reload config, keeping current one')
+            raise
+
+        changes = []
+        if old.loggers != new.loggers:
+            init_logging()
+            changes.append('loggers')
+
+        tunnels_changed = \
+            [t.dict() for t in old.networking.tunnels] != \
+            [t.dict() for t in new.networking.tunnels] or \
+            old.networking.tunnel_groups != new.networking.tunnel_groups
+        if tunnels_changed:
+            update_interfaces()
+            await reload_tunnels(old.networking.tunnels,
+                                 new.networking.tunnels)
+            changes.append('tunnels')
+
+        if await reload_domain_lists(old.manual_domain_lists,
+                                     old.external_domain_lists):
+            changes.append('domain_lists')
+
+        if await reload_ip_lists(old.external_ip_lists):
+            changes.append('ip_lists')
+
+        # Hosts and blocklist files may have changed even if the config
+        # did not, so they are always read again
+        if static_answers.load():
+            changes.append('static_answers')
+
+        if old.replication != new.replication:
+            await stop_replication()
+            await start_replication()
+            changes.append('replication')
+
+        if old.networking.dns_port != new.networking.dns_port:
+            logger.warning('networking.dns_port change requires restart')
+        if old.api_port != new.api_port:
+            logger.warning('api_port change requires restart')
+
+        if tunnels_changed or 'domain_lists' in changes or \
+                'ip_lists' in changes:
+            await re_route_all_domains()
+
+        logger.info(
+            f'Config reloaded, changed: {", ".join(changes) or "nothing"}')
+        return changes
@@ -8,6 +8,7 @@ from asyncio import (
     Queue,
     create_task,
     get_running_loop,
+    shield,
 )
 from enum import (
     IntEnum,
@@ -32,7 +33,21 @@ from aiodnsresolver import (
     DnsNoMatchingAnswers,
 )
 
+from answer_cache import answer_cache
 from config import get_config
+from dns_upstreams import get_secure_resolver
+from dns_wire import error_response, parse_question, WireAnswer
+from profiling import query_profiler
+from query_trace import trace_writer
+from rate_limiter import RateLimiter
+from static_answers import static_answers
+
+stats = {
+    'received': 0,
+    'rate_limited': 0,
+    'shed': 0,
+    'coalesced': 0,
+}
 
 
 def get_socket_default():
@@ -43,6 +58,8 @@ def get_socket_default():
 
 
 def get_resolver_default():
+    if get_config().networking.upstream.transport in ('dot', 'doh'):
+        return get_secure_resolver()
     return Resolver()
 
 
@@ -82,6 +99,7 @@ def DnsProxy(
     loop = get_running_loop()
     logger = get_logger_adapter({})
     request_id_alphabet = string.ascii_letters + string.digits
+    in_flight = {}
 
     # The "main" task of the server: it receives incoming requests and puts
     # them in a queue that is then fetched from and processed by the proxy
@@ -96,15 +114,44 @@ def DnsProxy(
             create_task(upstream_worker(sock, resolve, upstream_queue))
             for _ in range(0, num_workers)]
 
+        rate_limiter = RateLimiter()
+
+        def reject(request_data, addr, rcode, reason):
+            stats[reason] += 1
+            response_data = error_response(request_data, rcode)
+            if response_data is not None:
+                sock.sendto(response_data, addr)
+
         try:
             while True:
                 logger.info('Waiting for next request')
                 request_data, addr = (await recvfrom(loop, [(sock, None)], 512))[1]
+                stats['received'] += 1
+                trace_writer.record(addr[0], request_data)
+                limits = get_config().networking.dns_limits
+
+                if not rate_limiter.allow(addr[0], loop.time()):
+                    if limits.rate_limited_response == 'drop':
+                        stats['rate_limited'] += 1
+                    else:
+                        reject(request_data, addr, ERRORS.REFUSED,
+                               'rate_limited')
+                    continue
+
+                # Answering right away keeps the receive loop going, so
+                # well-behaved clients are not stuck behind a flood. Above
+                # 1 the queue would be full before anything is shed
+                if upstream_queue.qsize() >= upstream_queue.maxsize * \
+                        min(limits.shed_queue_fraction, 1):
+                    reject(request_data, addr, ERRORS.SERVFAIL, 'shed')
+                    continue
+
                 request_logger = get_logger_adapter(
                     {'dnsrewriteproxy_requestid': ''.join(
                         choices(request_id_alphabet, k=8))})
                 request_logger.info('Received request from %s', addr)
-                await upstream_queue.put((request_logger, request_data, addr))
+                upstream_queue.put_nowait(
+                    (request_logger, request_data, addr))
         finally:
             logger.info('Stopping: waiting for requests to finish')
             await upstream_queue.join()
@@ -126,6 +173,7 @@ def DnsProxy(
     async def upstream_worker(sock, resolve, upstream_queue):
         while True:
             request_logger, request_data, addr = await upstream_queue.get()
+            trace_token = query_profiler.begin_query()
 
             try:
                 request_logger.info('Processing request')
@@ -137,21 +185,54 @@ def DnsProxy(
             except Exception:
                 request_logger.exception('Error processing request')
             finally:
+                query_profiler.end_query(trace_token)
                 request_logger.info('Finished processing request')
                 upstream_queue.task_done()
 
     async def get_response_data(request_logger, resolve, request_data, addr):
+        with query_profiler.span('fast_path'):
+            response_data = await get_fast_response_data(request_logger,
+                                                         request_data, addr)
+        if response_data is not None:
+            return response_data
+
         # This may raise an exception, which is handled at a higher level.
         # We can't [and I suspect shouldn't try to] return an error to the
         # client, since we're not able to extract the QID, so the client won't
         # be able to match it with an outgoing request
-        query = parse(request_data)
+        with query_profiler.span('parse'):
+            query = parse(request_data)
 
         try:
-            return pack(await proxy(request_logger, resolve, query, addr))
+            response = await proxy(request_logger, resolve, query, addr)
         except Exception:
             request_logger.exception('Failed to proxy %s', query)
-            return pack(error(query, ERRORS.SERVFAIL))
+            response = error(query, ERRORS.SERVFAIL)
+
+        with query_profiler.span('pack'):
+            return pack(response)
+
+    async def get_fast_response_data(request_logger, request_data, addr):
+        # Answers from the packed answer cache straight from the request
+        # bytes. Anything else, or anything unusual, returns None and goes
+        # through the full parse and pack
+        if not get_config().networking.wire_fast_path:
+            return None
+        question = parse_question(request_data)
+        if question is None or question.qtype != TYPES.A:
+            return None
+        wire_answer = answer_cache.get_wire(question.name.lower(),
+                                            question.qtype, loop.time())
+        if wire_answer is None or wire_answer.domain in static_answers:
+            return None
+
+        request_logger.info('Fast path answer for %s', wire_answer.domain)
+        query_profiler.set_domain(wire_answer.domain)
+        if resolved_callback is not None:
+            with query_profiler.span('resolved_callback'):
+                await resolved_callback(addr, wire_answer.domain,
+                                        wire_answer.ip_addresses)
+        return wire_answer.response(request_data, question, loop.time())
 
     async def proxy(request_logger, resolve, query, addr):
         name_bytes = query.qd[0].name
@@ -159,18 +240,42 @@ def DnsProxy(
 
         name_str_lower = query.qd[0].name.lower().decode('idna')
         request_logger.info('Decoded: %s', name_str_lower)
-
-        if query.qd[0].qtype != TYPES.A:
-            request_logger.info('Unhandled query type: %s', query.qd[0].qtype)
+        query_profiler.set_domain(name_str_lower)
+
+        qtype = query.qd[0].qtype
+        with query_profiler.span('static'):
+            static_answer = static_answers.lookup(name_str_lower, qtype,
+                                                  loop.time())
+        if static_answer is not None:
+            request_logger.info('Static answer: %s', static_answer)
+            if static_answer.nxdomain:
+                return error(query, ERRORS.NXDOMAIN)
+            # Only IPv4 addresses are routed
+            if not static_answer.blocked and qtype == TYPES.A and \
+                    resolved_callback is not None:
+                with query_profiler.span('resolved_callback'):
+                    await resolved_callback(addr, name_str_lower,
+                                            static_answer.ip_addresses)
+            return answer(query, qtype, static_answer.ip_addresses)
+
+        if qtype != TYPES.A:
+            request_logger.info('Unhandled query type: %s', qtype)
             return error(query, ERRORS.REFUSED)
 
+        # Identical queries arriving while one is being resolved wait for it
+        # instead of asking upstream and installing routes again
+        key = (name_str_lower, TYPES.A)
+        lookup = in_flight.get(key)
+        if lookup is None:
+            lookup = in_flight[key] = create_task(resolve_and_route(
+                request_logger, resolve, name_bytes, name_str_lower, addr))
+            lookup.add_done_callback(lambda _: in_flight.pop(key, None))
+        else:
+            stats['coalesced'] += 1
+            request_logger.info('Coalesced with a query in flight')
+
         try:
-            ip_addresses = await resolve(
-                name_str_lower, TYPES.A,
-                get_logger_adapter=get_resolver_logger_adapter(request_logger))
-        except DnsNoMatchingAnswers:
-            request_logger.info('No matching answers')
-            ip_addresses = ()
+            ip_addresses = await shield(lookup)
         except DnsRecordDoesNotExist:
             request_logger.info('Does not exist')
             return error(query, ERRORS.NXDOMAIN)
@@ -179,17 +284,44 @@ def DnsProxy(
                                 dns_response_code_error.args[0])
             return error(query, dns_response_code_error.args[0])
 
+        return answer(query, TYPES.A, ip_addresses)
+
+    async def resolve_and_route(request_logger, resolve, name_bytes,
+                                name_str_lower, addr):
+        try:
+            with query_profiler.span('resolve'):
+                ip_addresses = answer_cache.get(name_str_lower, TYPES.A,
+                                                loop.time())
+                if ip_addresses is None:
+                    ip_addresses = await resolve(
+                        name_str_lower, TYPES.A,
+                        get_logger_adapter=get_resolver_logger_adapter(
+                            request_logger))
+                    answer_cache.put(name_str_lower, TYPES.A, ip_addresses)
+        except DnsNoMatchingAnswers:
+            request_logger.info('No matching answers')
+            ip_addresses = ()
+
         request_logger.info('Resolved to %s', ip_addresses)
-        now = loop.time()
+        if ip_addresses:
+            answer_cache.put_wire(
+                name_bytes.lower(), TYPES.A,
+                WireAnswer(name_str_lower, TYPES.A, ip_addresses))
 
         if resolved_callback is not None:
-            await resolved_callback(addr, name_str_lower, ip_addresses)
+            with query_profiler.span('resolved_callback'):
+                await resolved_callback(addr, name_str_lower, ip_addresses)
+
+        return ip_addresses
+
+    def answer(query, qtype, ip_addresses):
+        now = loop.time()
 
         def ttl(ip_address):
             return int(max(0.0, ip_address.expires_at - now))
 
         response_records = tuple(
-            ResourceRecord(name=name_bytes, qtype=TYPES.A,
+            ResourceRecord(name=query.qd[0].name, qtype=qtype,
                            qclass=1, ttl=ttl(ip_address),
                            rdata=ip_address.packed)
             for ip_address in ip_addresses
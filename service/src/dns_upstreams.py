@@ -0,0 +1,261 @@
+import asyncio
+import itertools
+import ssl
+import struct
+from random import randrange
+from typing import Optional
+from urllib.parse import urlparse
+
+import aiohttp
+from aiodnsresolver import (
+    QUESTION,
+    TYPES,
+    DnsError,
+    DnsNoMatchingAnswers,
+    DnsRecordDoesNotExist,
+    DnsResponseCode,
+    DnsSocketError,
+    DnsTimeout,
+    IPv4AddressExpiresAt,
+    IPv6AddressExpiresAt,
+    Message,
+    QuestionRecord,
+    pack,
+    parse,
+)
+
+from config import get_config, UpstreamConfig
+from logger import logger
+
+LENGTH = struct.Struct('!H')
+MIN_BACKOFF_SECONDS = 0.5
+
+
+def _get_ssl_context(upstream_config: UpstreamConfig) -> ssl.SSLContext:
+    context = ssl.create_default_context(cafile=upstream_config.tls_ca_file)
+    if not upstream_config.tls_verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class DotConnection:
+    # A single persistent DNS-over-TLS connection. Queries are pipelined:
+    # they are written as soon as they come and answers are matched to them
+    # by query id, in whatever order the server sends them
+    _writer: Optional[asyncio.StreamWriter]
+    _pending: dict[int, asyncio.Future]
+
+    def __init__(self, host: str, port: int, upstream_config: UpstreamConfig):
+        self._host = host
+        self._port = port
+        self._config = upstream_config
+        self._writer = None
+        self._pending = {}
+        self._connected = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    async def _run(self):
+        backoff = MIN_BACKOFF_SECONDS
+        while True:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(
+                        self._host, self._port,
+                        ssl=_get_ssl_context(self._config),
+                        server_hostname=self._config.tls_server_name or
+                        self._host),
+                    self._config.timeout_seconds)
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning(f'Failed to connect to {self._host}:'
+                               f'{self._port}: {e!r}, retrying in {backoff}s')
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self._config.max_backoff_seconds)
+                continue
+
+            logger.info(f'Connected to DoT upstream {self._host}:{self._port}')
+            backoff = MIN_BACKOFF_SECONDS
+            self._writer = writer
+            self._connected.set()
+            try:
+                await self._read_responses(reader)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                logger.info(f'DoT connection to {self._host} closed: {e!r}')
+            finally:
+                self._connected.clear()
+                self._writer = None
+                writer.close()
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(DnsSocketError())
+                self._pending.clear()
+
+    async def _read_responses(self, reader: asyncio.StreamReader):
+        while True:
+            length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+            data = await reader.readexactly(length)
+            qid, = LENGTH.unpack_from(data)
+            future = self._pending.pop(qid, None)
+            if future is not None and not future.done():
+                future.set_result(data)
+
+    async def query(self, message: Message) -> bytes:
+        await asyncio.wait_for(self._connected.wait(),
+                               self._config.timeout_seconds)
+        qid = randrange(65536)
+        while qid in self._pending:
+            qid = randrange(65536)
+        data = pack(message._replace(qid=qid))
+        future = asyncio.get_running_loop().create_future()
+        self._pending[qid] = future
+        try:
+            self._writer.write(LENGTH.pack(len(data)) + data)
+            return await asyncio.wait_for(future,
+                                          self._config.timeout_seconds)
+        finally:
+            self._pending.pop(qid, None)
+
+
+class DotUpstream:
+    _connections: list[DotConnection]
+
+    def __init__(self, upstream_config: UpstreamConfig):
+        self._connections = []
+        for server in upstream_config.dot_servers:
+            host, _, port = server.partition(':')
+            self._connections += [
+                DotConnection(host, int(port or 853), upstream_config)
+                for _ in range(upstream_config.pool_size)]
+        self._next = itertools.cycle(self._connections)
+
+    def start(self):
+        for connection in self._connections:
+            connection.start()
+
+    async def stop(self):
+        for connection in self._connections:
+            await connection.stop()
+
+    async def query(self, message: Message) -> bytes:
+        # Prefer a live connection, but wait for one to come up otherwise
+        for _ in range(len(self._connections)):
+            connection = next(self._next)
+            if connection.connected:
+                break
+        return await connection.query(message)
+
+
+class DohUpstream:
+    _session: Optional[aiohttp.ClientSession]
+
+    def __init__(self, upstream_config: UpstreamConfig):
+        self._config = upstream_config
+        self._session = None
+
+    def start(self):
+        # One session for all queries, so TLS and HTTP connections are kept
+        # alive and reused
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self._config.pool_size,
+                keepalive_timeout=60,
+                ssl=_get_ssl_context(self._config)),
+            timeout=aiohttp.ClientTimeout(
+                total=self._config.timeout_seconds))
+
+    async def stop(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def query(self, message: Message) -> bytes:
+        try:
+            async with self._session.post(
+                    self._config.doh_url,
+                    data=pack(message._replace(qid=0)),
+                    headers={'Content-Type': 'application/dns-message',
+                             'Accept': 'application/dns-message'}) as resp:
+                if resp.status != 200:
+                    raise DnsError(f'DoH upstream returned {resp.status}')
+                return await resp.read()
+        except aiohttp.ClientError as e:
+            raise DnsSocketError() from e
+
+
+def _answers(response: Message, fqdn: bytes, qtype: int, now: float):
+    # Follows the CNAME chain within the answer section
+    name = fqdn.lower()
+    expires_at = float('inf')
+    for _ in range(len(response.an) + 1):
+        records = [r for r in response.an if r.name.lower() == name]
+        matching = [r for r in records if r.qtype == qtype]
+        if matching:
+            address_type = IPv4AddressExpiresAt if qtype == TYPES.A else \
+                IPv6AddressExpiresAt
+            return tuple(
+                address_type(r.rdata, min(expires_at, now + r.ttl))
+                for r in matching)
+        cnames = [r for r in records if r.qtype == TYPES.CNAME]
+        if not cnames:
+            break
+        expires_at = min(expires_at, now + cnames[0].ttl)
+        name = cnames[0].rdata.lower()
+    raise DnsNoMatchingAnswers()
+
+
+def get_secure_resolver():
+    upstream_config = get_config().networking.upstream
+    upstream = DotUpstream(upstream_config) \
+        if upstream_config.transport == 'dot' else \
+        DohUpstream(upstream_config)
+    upstream.start()
+    loop = asyncio.get_running_loop()
+
+    async def resolve(fqdn_str, qtype, get_logger_adapter=None):
+        fqdn = fqdn_str.encode('idna')
+        message = Message(
+            qid=0, qr=QUESTION, opcode=0, aa=0, tc=0, rd=1, ra=0, z=0,
+            rcode=0, qd=(QuestionRecord(fqdn, qtype, qclass=1),),
+            an=(), ns=(), ar=())
+        now = loop.time()
+        try:
+            response = parse(await upstream.query(message))
+        except asyncio.TimeoutError:
+            raise DnsTimeout()
+        if response.rcode == 3:
+            raise DnsRecordDoesNotExist()
+        if response.rcode:
+            raise DnsResponseCode(response.rcode)
+        return _answers(response, fqdn, qtype, now)
+
+    async def warm_up():
+        try:
+            hostname = urlparse(upstream_config.doh_url).hostname \
+                if upstream_config.transport == 'doh' else \
+                upstream_config.tls_server_name or 'example.com'
+            await resolve(hostname, TYPES.A)
+            logger.info(f'{upstream_config.transport} upstream is ready')
+        except Exception as e:  # noqa
+            logger.warning(f'Upstream warm-up failed: {e!r}')
+
+    warm_up_task = asyncio.create_task(warm_up())
+
+    async def clear_cache():
+        warm_up_task.cancel()
+        await upstream.stop()
+
+    return resolve, clear_cache
@@ -0,0 +1,106 @@
+# Minimal handling of DNS messages at the byte level, for the cases where a
+# full aiodnsresolver parse and pack is not worth it
+import struct
+from typing import NamedTuple, Optional
+
+HEADER = struct.Struct('!HHHHHH')
+QTYPE_QCLASS = struct.Struct('!HH')
+# Answer record with its name as a pointer to the question
+RECORD = struct.Struct('!HHHLH')
+TTL = struct.Struct('!L')
+QR = 0x8000
+RA = 0x0080
+OPCODE = 0x7800
+OPCODE_RD_MASK = 0x7900
+QUESTION_POINTER = 0xC000 | HEADER.size
+RECORD_TTL_OFFSET = 6
+
+
+def question_end(data: bytes) -> Optional[int]:
+    # Offset right after the single question, or None if the request has
+    # anything unusual in it
+    if len(data) < HEADER.size:
+        return None
+    _, flags, qdcount, _, _, _ = HEADER.unpack_from(data)
+    if flags & QR or qdcount != 1:
+        return None
+    position = HEADER.size
+    while True:
+        if position >= len(data):
+            return None
+        length = data[position]
+        if length == 0:
+            break
+        if length >= 64:
+            # Compression pointers are not expected in a question
+            return None
+        position += length + 1
+    position += 5
+    return position if position <= len(data) else None
+
+
+def error_response(request_data: bytes, rcode: int) -> Optional[bytes]:
+    end = question_end(request_data)
+    if end is None:
+        return None
+    qid, flags, _, _, _, _ = HEADER.unpack_from(request_data)
+    flags = QR | (flags & OPCODE_RD_MASK) | RA | rcode
+    return HEADER.pack(qid, flags, 1, 0, 0, 0) + \
+        request_data[HEADER.size:end]
+
+
+class Question(NamedTuple):
+    qid: int
+    name: bytes
+    qtype: int
+    end: int
+
+
+def parse_question(data: bytes) -> Optional[Question]:
+    end = question_end(data)
+    if end is None:
+        return None
+    qid, flags, _, _, _, _ = HEADER.unpack_from(data)
+    if flags & OPCODE:
+        return None
+    labels = []
+    position = HEADER.size
+    while data[position]:
+        length = data[position]
+        labels.append(data[position + 1:position + 1 + length])
+        position += length + 1
+    qtype, qclass = QTYPE_QCLASS.unpack_from(data, end - QTYPE_QCLASS.size)
+    if qclass != 1:
+        return None
+    return Question(qid, b'.'.join(labels), qtype, end)
+
+
+class WireAnswer:
+    # Answer records packed once, with names pointing at the question, so
+    # they can follow the question of any request for the same name. Only
+    # the ID and TTLs have to be written for each response
+    domain: str
+    ip_addresses: tuple
+    expires_at: float
+    _records: bytearray
+    _ttls: list[tuple[int, float]]
+
+    def __init__(self, domain: str, qtype: int, ip_addresses: tuple):
+        self.domain = domain
+        self.ip_addresses = ip_addresses
+        self.expires_at = min(ip.expires_at for ip in ip_addresses)
+        self._records = bytearray()
+        self._ttls = []
+        for ip in ip_addresses:
+            self._ttls.append((len(self._records) + RECORD_TTL_OFFSET,
+                               ip.expires_at))
+            self._records += RECORD.pack(QUESTION_POINTER, qtype, 1, 0,
+                                         len(ip.packed)) + ip.packed
+
+    def response(self, request_data: bytes, question: Question,
+                 now: float) -> bytes:
+        for offset, expires_at in self._ttls:
+            TTL.pack_into(self._records, offset,
+                          int(max(0.0, expires_at - now)))
+        return HEADER.pack(question.qid, QR | RA, 1, len(self._ttls), 0, 0) + \
+            request_data[HEADER.size:question.end] + self._records
@@ -1,57 +1,214 @@
-from typing import Coroutine, Optional, Any, Callable
+import asyncio
+from collections import OrderedDict
+from typing import Callable, Optional
 
 import aiohttp
 
 from config import ExternalDomainList, get_config, DomainList
-from domain_matchers import DomainMatcher, SerializableDomainMatcher
+from domain_matchers import DomainMatcher, SerializableDomainMatcher, \
+    PatternAutomaton
 from logger import logger
-from scheduled import scheduled
+from scheduler import scheduler
 
 lists: dict[DomainList, DomainMatcher] = {}
-
-
-def init_external_domain_lists() -> list[
-    Callable[[], Coroutine[Any, Any, Optional[Any]]]]:
-    async def update(list_config: ExternalDomainList, matcher: DomainMatcher):
-        logger.info(f'Updating list {list_config.name}')
-        async with aiohttp.ClientSession() as session:
-            async with session.get(list_config.url) as resp:
-                assert resp.status == 200
-                await matcher.update((await resp.text()).splitlines())
-                logger.info(f'Updated list {list_config.name}')
-
-    def init() -> list[Callable[[], Coroutine[Any, Any, Optional[Any]]]]:
-        result = []
-        for list_config in get_config().external_domain_lists:
-            matcher = DomainMatcher()
-            lists[list_config] = matcher
-
-            @scheduled(list_config.update_interval_hours * 3600)
-            async def task():
-                await update(list_config, matcher)
-
-            result.append(task)
-
-        return result
-
-    return init()
+EditListener = Callable[[DomainList, str, list[str]], None]
+_edit_listeners: list[EditListener] = []
+_pattern_automaton = PatternAutomaton(())
+_pattern_generation = 0
+_compiled_pattern_generation = 0
+
+# Changes whenever the set of lists or the compiled patterns change, matcher
+# contents are tracked by DomainMatcher.last_generation
+_lists_generation = 0
+_match_cache: OrderedDict[str, Optional[DomainList]] = OrderedDict()
+_match_cache_generation = (0, 0)
+_match_cache_hits = 0
+_match_cache_misses = 0
+
+
+async def recompile_patterns():
+    global _pattern_automaton, _pattern_generation, \
+        _compiled_pattern_generation, _lists_generation
+    _pattern_generation += 1
+    generation = _pattern_generation
+    patterns = [(list_config, pattern)
+                for list_config, matcher in lists.items()
+                for pattern in matcher.patterns]
+    automaton = await asyncio.get_running_loop().run_in_executor(
+        None, PatternAutomaton, patterns)
+    # Compilations may finish out of order, keep the newest one
+    if generation > _compiled_pattern_generation:
+        _compiled_pattern_generation = generation
+        _pattern_automaton = automaton
+        _lists_generation += 1
+        logger.info(f'Compiled {len(patterns)} domain patterns')
+
+
+async def update_external_domain_list(list_config: ExternalDomainList,
+                                      matcher: DomainMatcher):
+    logger.info(f'Updating list {list_config.name}')
+    async with aiohttp.ClientSession() as session:
+        async with session.get(list_config.url) as resp:
+            assert resp.status == 200
+            await matcher.update((await resp.text()).splitlines())
+            logger.info(f'Updated list {list_config.name}')
+
+
+def _start_external_domain_list(list_config: ExternalDomainList,
+                                matcher: DomainMatcher):
+    scheduler.add(f'domain_list:{list_config.name}',
+                  lambda: update_external_domain_list(list_config, matcher),
+                  list_config.update_interval_hours * 3600)
+
+
+def _stop_external_domain_list(name: str):
+    scheduler.remove(f'domain_list:{name}')
+
+
+def _set_lists(matchers: dict[DomainList, DomainMatcher]):
+    global _lists_generation
+    # Lists are matched in config order: manual lists first, then external
+    config = get_config()
+    ordered = {}
+    for list_config in config.manual_domain_lists + \
+            config.external_domain_lists:
+        if list_config in matchers:
+            ordered[list_config] = matchers[list_config]
+    lists.clear()
+    lists.update(ordered)
+    for matcher in ordered.values():
+        matcher.on_patterns_changed = recompile_patterns
+    _lists_generation += 1
+
+
+async def start_external_domain_lists():
+    matchers = dict(lists)
+    for list_config in get_config().external_domain_lists:
+        matcher = DomainMatcher()
+        matchers[list_config] = matcher
+        _start_external_domain_list(list_config, matcher)
+    _set_lists(matchers)
+    await recompile_patterns()
+
+
+def add_edit_listener(listener: EditListener):
+    _edit_listeners.append(listener)
+
+
+def _notify_edit(list_config: DomainList, action: str, domains: list[str]):
+    for listener in _edit_listeners:
+        listener(list_config, action, domains)
+
+
+async def _load_manual_domain_list(list_config: DomainList) -> DomainMatcher:
+    matcher = SerializableDomainMatcher(f'list_{list_config.name}.txt')
+    matcher.on_edited = lambda action, domains: \
+        _notify_edit(list_config, action, domains)
+    try:
+        logger.info(f'Loading manual list {list_config.name}')
+        await matcher.load()
+    except FileNotFoundError as e:
+        logger.info(f'File {e.filename} not found, creating new one')
+        matcher.dump_empty()
+    return matcher
 
 
 async def init_manual_domain_lists():
+    matchers = dict(lists)
     for list_config in get_config().manual_domain_lists:
-        matcher = SerializableDomainMatcher(f'list_{list_config.name}.txt')
-        try:
-            logger.info(f'Loading manual list {list_config.name}')
-            await matcher.load()
-        except FileNotFoundError as e:
-            logger.info(f'File {e.filename} not found, creating new one')
-            matcher.dump_empty()
-        lists[list_config] = matcher
+        matchers[list_config] = await _load_manual_domain_list(list_config)
+    _set_lists(matchers)
+    await recompile_patterns()
+
+
+async def reload_domain_lists(old_manual: list[DomainList],
+                              old_external: list[ExternalDomainList]) -> bool:
+    config = get_config()
+    matchers_by_name = {list_config.name: matcher
+                        for list_config, matcher in lists.items()}
+    matchers = {}
+    changed = False
+
+    old_manual_by_name = {c.name: c for c in old_manual}
+    for list_config in config.manual_domain_lists:
+        old_config = old_manual_by_name.pop(list_config.name, None)
+        if old_config is None:
+            logger.info(f'Adding manual list {list_config.name}')
+            matchers[list_config] = \
+                await _load_manual_domain_list(list_config)
+            changed = True
+        else:
+            changed |= old_config != list_config
+            matchers[list_config] = matchers_by_name[list_config.name]
+    for name in old_manual_by_name:
+        logger.info(f'Removing manual list {name}')
+        changed = True
+
+    old_external_by_name = {c.name: c for c in old_external}
+    for list_config in config.external_domain_lists:
+        old_config = old_external_by_name.pop(list_config.name, None)
+        if old_config is not None and old_config.dict() == list_config.dict():
+            matchers[list_config] = matchers_by_name[list_config.name]
+            continue
+
+        changed = True
+        if old_config is not None and old_config.url == list_config.url:
+            logger.info(f'Rescheduling external list {list_config.name}')
+            matcher = matchers_by_name[list_config.name]
+        else:
+            logger.info(f'Adding external list {list_config.name}')
+            matcher = DomainMatcher()
+        _stop_external_domain_list(list_config.name)
+        _start_external_domain_list(list_config, matcher)
+        matchers[list_config] = matcher
+    for name in old_external_by_name:
+        logger.info(f'Removing external list {name}')
+        _stop_external_domain_list(name)
+        changed = True
+
+    _set_lists(matchers)
+    await recompile_patterns()
+    return changed
 
 
 def match_domain(domain: str) -> Optional[DomainList]:
+    global _match_cache_generation, _match_cache_hits, _match_cache_misses
+    generation = (DomainMatcher.last_generation, _lists_generation)
+    if generation != _match_cache_generation:
+        _match_cache.clear()
+        _match_cache_generation = generation
+
+    try:
+        domain_list = _match_cache[domain]
+    except KeyError:
+        _match_cache_misses += 1
+    else:
+        _match_cache_hits += 1
+        _match_cache.move_to_end(domain)
+        return domain_list
+
+    domain_list = _match_domain_uncached(domain)
+    _match_cache[domain] = domain_list
+    if len(_match_cache) > get_config().match_cache_size:
+        _match_cache.popitem(last=False)
+    return domain_list
+
+
+def get_match_cache_stats():
+    total = _match_cache_hits + _match_cache_misses
+    return {
+        'size': len(_match_cache),
+        'hits': _match_cache_hits,
+        'misses': _match_cache_misses,
+        'hit_rate': _match_cache_hits / total if total else 0.0,
+    }
+
+
+def _match_domain_uncached(domain: str) -> Optional[DomainList]:
+    pattern_matches = _pattern_automaton.match(domain)
     return next((list_config for list_config, matcher in lists.items()
-                 if matcher.match(domain)), None)
+                 if list_config in pattern_matches or
+                 matcher.match_suffix(domain)), None)
 
 
 def get_manual_domain_lists() -> dict[str, DomainList]:
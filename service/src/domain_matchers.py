@@ -1,18 +1,113 @@
-from bisect import bisect, bisect_left
+import asyncio
+import itertools
+import re
+from bisect import bisect, bisect_left, bisect_right
+from collections import deque
+from fnmatch import translate
+from typing import Awaitable, Callable, Hashable, Iterable, Optional
 
 import aiofiles as aiofiles
 
+from logger import logger
+
+KEYWORD_PREFIX = 'keyword:'
+REGEXP_PREFIX = 'regexp:'
+GLOB_CHARS = re.compile(r'[*?\[]')
+# Names of the groups around each regexp, to find the list it belongs to
+OWNER_GROUP = re.compile(r'p\d+')
+# Group numbers change once regexps are joined, so numbered backreferences
+# would refer to the wrong group
+NUMBERED_BACKREFERENCE = re.compile(r'\\(?:[1-9]|g<\d+>)')
+
+_generations = itertools.count(1)
+
+
+def is_pattern(entry: str) -> bool:
+    return entry.startswith((KEYWORD_PREFIX, REGEXP_PREFIX)) or \
+        GLOB_CHARS.search(entry) is not None
+
+
+class DomainIndex:
+    # Sorted entries of a list for paging through them. Substring search
+    # scans one joined string, which is much faster than testing every
+    # entry in Python
+    generation: int
+    domains: list[str]
+    _blob: str
+    _offsets: list[int]
+
+    def __init__(self, domains: list[str], generation: int):
+        self.generation = generation
+        self.domains = sorted(domains)
+        self._blob = '\n'.join(self.domains)
+        self._offsets = list(itertools.accumulate(
+            (len(domain) + 1 for domain in self.domains[:-1]), initial=0))
+
+    def page(self, cursor: Optional[str], limit: int,
+             prefix: Optional[str] = None,
+             substring: Optional[str] = None) -> tuple[list[str], bool]:
+        # substring must not contain '\n', it would match across entries
+        domains = self.domains
+        start = bisect_right(domains, cursor) if cursor is not None else 0
+        end = len(domains)
+        if prefix:
+            start = max(start, bisect_left(domains, prefix))
+            end = bisect_left(domains, prefix + '\U0010ffff')
+
+        if not substring:
+            return domains[start:min(end, start + limit)], start + limit < end
+
+        items = []
+        position = self._offsets[start] if start < end else len(self._blob)
+        end_position = self._offsets[end] if end < len(domains) else \
+            len(self._blob)
+        while True:
+            position = self._blob.find(substring, position, end_position)
+            if position < 0:
+                return items, False
+            i = bisect(self._offsets, position) - 1
+            if len(items) == limit:
+                return items, True
+            items.append(domains[i])
+            position = self._offsets[i + 1] if i + 1 < len(domains) else \
+                len(self._blob)
+
 
 class DomainMatcher:
+    # Bumped on every change of any matcher, so cached match results can be
+    # invalidated by comparing a single number
+    last_generation: int = 0
+
     _prefixes: list[str]
+    _patterns: list[str]
+    _index: Optional[DomainIndex]
+    generation: int
+    on_patterns_changed: Optional[Callable[[], Awaitable[None]]]
 
     def __init__(self):
         self._prefixes = []
+        self._patterns = []
+        self._index = None
+        self._bump_generation()
+        self.on_patterns_changed = None
+
+    def _bump_generation(self):
+        self.generation = next(_generations)
+        DomainMatcher.last_generation = self.generation
 
     async def update(self, domain_suffixes):
-        self._prefixes = sorted(s[::-1] for s in domain_suffixes)
+        prefixes = []
+        patterns = []
+        for entry in domain_suffixes:
+            if is_pattern(entry):
+                patterns.append(entry)
+            else:
+                prefixes.append(entry[::-1])
+        self._prefixes = sorted(prefixes)
+        self._bump_generation()
+        await self._set_patterns(sorted(set(patterns)))
 
-    def match(self, domain: str) -> bool:
+    def match_suffix(self, domain: str) -> bool:
         domain = domain[::-1]
         p = bisect(self._prefixes, domain)
         if p == 0:
@@ -20,48 +115,100 @@ class DomainMatcher:
         return domain.startswith(self._prefixes[p - 1])
 
     async def add(self, domain: str):
+        if is_pattern(domain):
+            if domain not in self._patterns:
+                await self._set_patterns(sorted(self._patterns + [domain]))
+            return
         domain = domain[::-1]
         p = bisect_left(self._prefixes, domain)
         if p < len(self._prefixes) and self._prefixes[p] == domain:
             return
         self._prefixes.insert(p, domain)
+        self._bump_generation()
 
     async def remove(self, domain: str):
+        if is_pattern(domain):
+            if domain in self._patterns:
+                await self._set_patterns(
+                    [p for p in self._patterns if p != domain])
+            return
         domain = domain[::-1]
         p = bisect_left(self._prefixes, domain)
         if p < len(self._prefixes) and self._prefixes[p] == domain:
             self._prefixes.pop(p)
+            self._bump_generation()
+
+    @property
+    def patterns(self) -> list[str]:
+        return self._patterns
+
+    async def _set_patterns(self, patterns: list[str]):
+        if patterns == self._patterns:
+            return
+        self._patterns = patterns
+        self._bump_generation()
+        if self.on_patterns_changed is not None:
+            await self.on_patterns_changed()
 
     def get_all(self):
-        return sorted(s[::-1] for s in self._prefixes)
+        return sorted(s[::-1] for s in self._prefixes) + self._patterns
+
+    async def get_index(self) -> DomainIndex:
+        if self._index is None or self._index.generation != self.generation:
+            generation = self.generation
+            index = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: DomainIndex(self.get_all(), generation))
+            if generation == self.generation:
+                self._index = index
+            return index
+        return self._index
+
+    def dump_state(self) -> list[str]:
+        return list(self._prefixes) + self._patterns
+
+    def load_state(self, prefixes: list[str]):
+        self._prefixes = [p for p in prefixes if not is_pattern(p)]
+        self._patterns = [p for p in prefixes if is_pattern(p)]
+        self._bump_generation()
 
 
 class SerializableDomainMatcher(DomainMatcher):
     _file_name: str
+    # Called with the kind of edit and the domains, after it is saved
+    on_edited: Optional[Callable[[str, list[str]], None]]
 
     def __init__(self, file_name: str):
         super().__init__()
         self._file_name = file_name
+        self.on_edited = None
+
+    def _edited(self, action: str, domains: list[str]):
+        if self.on_edited is not None:
+            self.on_edited(action, domains)
 
     async def update(self, domain_suffixes):
+        domain_suffixes = list(domain_suffixes)
         await super().update(domain_suffixes)
         await self.dump()
+        self._edited('update', domain_suffixes)
 
     async def add(self, domain: str):
         await super().add(domain)
         await self.dump()
+        self._edited('add', [domain])
 
     async def remove(self, domain: str):
         await super().remove(domain)
         await self.dump()
+        self._edited('remove', [domain])
 
     def dump_empty(self):
-        assert self._prefixes == []
+        assert self._prefixes == [] and self._patterns == []
         with open(self._file_name, 'w') as file:
             pass
 
     async def dump(self):
-        prefixes = '\n'.join(sorted(p[::-1] for p in self._prefixes))
+        prefixes = '\n'.join(self.get_all())
         async with aiofiles.open(self._file_name, 'w') as file:
             await file.write(prefixes)
 
@@ -71,3 +218,127 @@ class SerializableDomainMatcher(DomainMatcher):
             await super().update(
                 line for line in stripped_lines if line
             )
+
+
+# Matches a domain against keyword, glob and regexp entries of all lists at
+# once. Keywords and the longest literal part of globs go into one
+# Aho-Corasick automaton, so a lookup does not scan every pattern; a glob is
+# only verified when its literal part was seen. Regexps are joined into one
+# alternation in list order, so the first matching one belongs to the first
+# matching list.
+class PatternAutomaton:
+    _goto: list[dict[str, int]]
+    _fail: list[int]
+    _outputs: list[list[tuple[Hashable, Optional[re.Pattern]]]]
+    _unanchored_globs: list[tuple[Hashable, re.Pattern]]
+    _regexp: Optional[re.Pattern]
+    _regexp_owners: dict[str, Hashable]
+
+    def __init__(self, patterns: Iterable[tuple[Hashable, str]]):
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+        self._unanchored_globs = []
+        regexps = []
+        group_names = set()
+        self._regexp_owners = {}
+
+        for i, (owner, pattern) in enumerate(patterns):
+            if pattern.startswith(KEYWORD_PREFIX):
+                self._add_literal(pattern[len(KEYWORD_PREFIX):].lower(),
+                                  (owner, None))
+            elif pattern.startswith(REGEXP_PREFIX):
+                regexp = pattern[len(REGEXP_PREFIX):]
+                error = self._check_regexp(regexp, group_names)
+                if error is not None:
+                    logger.warning(f'Skipping pattern {pattern}: {error}')
+                    continue
+                group = f'p{i}'
+                regexps.append(f'(?P<{group}>{regexp})')
+                self._regexp_owners[group] = owner
+            else:
+                glob = re.compile(translate(pattern.lower()))
+                literal = max(re.split(r'\*|\?|\[[^]]*]', pattern.lower()),
+                              key=len)
+                if literal:
+                    self._add_literal(literal, (owner, glob))
+                else:
+                    self._unanchored_globs.append((owner, glob))
+
+        try:
+            self._regexp = re.compile('|'.join(regexps)) if regexps else None
+        except re.error as e:
+            logger.warning(f'Skipping all regexp patterns: {e}')
+            self._regexp = None
+        self._build_failure_links()
+
+    @staticmethod
+    def _check_regexp(regexp: str, group_names: set[str]) -> Optional[str]:
+        # Each regexp must also be valid once joined with the others
+        try:
+            compiled = re.compile(regexp)
+        except re.error as e:
+            return str(e)
+        if compiled.flags & ~re.UNICODE:
+            return 'inline flags must be scoped, e.g. (?i:...)'
+        if compiled.groups and NUMBERED_BACKREFERENCE.search(regexp):
+            return 'numbered backreferences are not supported'
+        names = set(compiled.groupindex)
+        if any(OWNER_GROUP.fullmatch(name) for name in names):
+            return 'group names like p1 are reserved'
+        if names & group_names:
+            return f'group names {sorted(names & group_names)} are taken'
+        group_names.update(names)
+        return None
+
+    def _add_literal(self, literal: str, output):
+        state = 0
+        for char in literal:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+            state = next_state
+        self._outputs[state].append(output)
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._outputs[next_state] = \
+                    self._outputs[next_state] + \
+                    self._outputs[self._fail[next_state]]
+
+    def match(self, domain: str) -> set[Hashable]:
+        owners = set()
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+        state = 0
+        for char in domain:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for owner, glob in outputs[state]:
+                if glob is None or glob.match(domain):
+                    owners.add(owner)
+
+        for owner, glob in self._unanchored_globs:
+            if glob.match(domain):
+                owners.add(owner)
+
+        if self._regexp is not None:
+            values = self._regexp.fullmatch(domain)
+            if values is not None:
+                owners.add(self._regexp_owners[values.lastgroup])
+
+        return owners
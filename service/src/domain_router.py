@@ -1,38 +1,213 @@
+import asyncio
 import itertools
 from collections import deque
-from typing import Deque
+from typing import Callable, Deque, Optional
 
-from config import DomainList, get_config
+from config import DomainList, get_config, InterfaceConfig, TunnelGroup
 from domain_lists import match_domain
-from ip_route import del_route, add_route
+from domain_matchers import is_pattern
+from ip_lists import match_ip
+from ip_route import del_route, add_route, add_default_routes, \
+    get_routed_ips, has_default_routes, has_routes, move_routes, \
+    note_default_routes
 from logger import logger
+from route_pipeline import route_pipeline, PRIORITY_RESOLVE, \
+    PRIORITY_BACKGROUND
+from tunnel_health import tunnel_health
 
 MAX_LAST_RESOLVED_DOMAINS = 1000
+# Plan key for IPs that need a host route via the default gateway. Not a
+# valid interface name, so it cannot clash with one
+DEFAULT_GATEWAY = 'default gateway'
 _last_routed_domains: Deque[tuple[str, list[str]]] = deque(
     maxlen=MAX_LAST_RESOLVED_DOMAINS)
 
-iface_name_to_config = {
-    config.name: config for config in get_config().networking.tunnels
-}
+iface_name_to_config: dict[str, InterfaceConfig] = {}
+group_name_to_config: dict[str, TunnelGroup] = {}
+# IPs routed through each tunnel group, to move them when the group switches
+_group_ips: dict[str, set[str]] = {}
+# Called for routing decisions that needed routes to be changed
+RouteListener = Callable[[str, list[str]], None]
+_route_listeners: list[RouteListener] = []
 
 
-async def route_domain(domain_list: DomainList, domain: str, ips: list[str]):
-    _last_routed_domains.append((domain, ips))
+def update_interfaces():
+    networking = get_config().networking
+    iface_name_to_config.clear()
+    iface_name_to_config.update({
+        config.name: config for config in networking.tunnels
+    })
+    group_name_to_config.clear()
+    group_name_to_config.update({
+        config.name: config for config in networking.tunnel_groups
+    })
+    for group in networking.tunnel_groups:
+        unknown = [name for name in group.tunnels
+                   if name not in iface_name_to_config]
+        if unknown:
+            logger.warning(f'Tunnel group {group.name} has tunnels that are '
+                           f'not configured: {", ".join(unknown)}')
+
+
+update_interfaces()
+
+
+def _get_interface(interface_name: str) -> InterfaceConfig:
+    group = group_name_to_config.get(interface_name)
+    if group is not None:
+        return iface_name_to_config[tunnel_health.get_active(group)]
+    return iface_name_to_config[interface_name]
+
 
+def _plan_routes(domain_list: Optional[DomainList], ips: list[str]) \
+        -> dict[Optional[str], list[str]]:
+    # Maps interface (or group) names to IPs to route through them, None
+    # stands for the default route
     if domain_list is not None:
-        if domain_list.name == 'force_default':
-            logger.debug(f'Forcing default route to %s for %s', ips, domain)
-            await del_route(ips)
-            return
+        if domain_list.name != 'force_default':
+            return {domain_list.interface: ips}
+        # A preinstalled prefix route would send these through its tunnel
+        plan = {}
+        for ip in ips:
+            ip_list = match_ip(ip)
+            plan.setdefault(
+                DEFAULT_GATEWAY
+                if ip_list is not None and ip_list.preinstall_routes
+                else None, []).append(ip)
+        return plan
+
+    plan = {}
+    for ip in ips:
+        ip_list = match_ip(ip)
+        # Networks of lists with preinstalled routes are already routed,
+        # a host route would only shadow them
+        interface_name = ip_list.interface \
+            if ip_list is not None and not ip_list.preinstall_routes \
+            else None
+        plan.setdefault(interface_name, []).append(ip)
+    return plan
+
+
+def _has_routes(interface_name: Optional[str], ips: list[str]) -> bool:
+    if interface_name is None:
+        return has_routes(None, ips)
+    if interface_name == DEFAULT_GATEWAY:
+        return has_default_routes(ips)
+    return has_routes(_get_interface(interface_name), ips)
+
+
+def _forget_group_ips(ips: list[str]):
+    for group_ips in _group_ips.values():
+        group_ips.difference_update(ips)
 
-        iface_config = iface_name_to_config[domain_list.interface]
-        logger.debug(f'Adding route to %s via %s for %s', ips,
+
+async def _apply_route(domain_list: Optional[DomainList], domain: str,
+                       ips: list[str]):
+    for interface_name, plan_ips in _plan_routes(domain_list, ips).items():
+        if interface_name is None:
+            logger.debug(f'Using default route to %s for %s', plan_ips,
+                         domain)
+            _forget_group_ips(plan_ips)
+            await del_route(plan_ips)
+            continue
+        if interface_name == DEFAULT_GATEWAY:
+            logger.debug(f'Adding route to %s via the default gateway for %s',
+                         plan_ips, domain)
+            _forget_group_ips(plan_ips)
+            await add_default_routes(plan_ips)
+            continue
+
+        iface_config = _get_interface(interface_name)
+        logger.debug(f'Adding route to %s via %s for %s', plan_ips,
                      iface_config.name, domain)
-        await add_route(iface_config, ips)
-    else:
-        logger.debug(f'No preferences for %s. Trying to remove route if any',
-                     domain)
-        await del_route(ips)
+        await add_route(iface_config, plan_ips)
+        if interface_name in group_name_to_config:
+            _group_ips.setdefault(interface_name, set()).update(plan_ips)
+
+
+async def route_domain(domain_list: Optional[DomainList], domain: str,
+                       ips: list[str]):
+    _last_routed_domains.append((domain, ips))
+
+    plan = _plan_routes(domain_list, ips)
+    for interface_name in (None, DEFAULT_GATEWAY):
+        if interface_name in plan:
+            note_default_routes(plan[interface_name])
+    if all(_has_routes(interface_name, plan_ips)
+           for interface_name, plan_ips in plan.items()):
+        return
+
+    for listener in _route_listeners:
+        listener(domain, ips)
+
+    # The DNS answer waits for the routes only up to a deadline, so a slow
+    # `ip route` call does not hold the client back for long
+    future = route_pipeline.submit(
+        PRIORITY_RESOLVE, lambda: _apply_route(domain_list, domain, ips))
+    try:
+        await asyncio.wait_for(
+            asyncio.shield(future),
+            get_config().networking.route_wait_ms / 1000)
+    except asyncio.TimeoutError:
+        logger.debug(f'Routes for %s are still pending', domain)
+
+
+def add_route_listener(listener: RouteListener):
+    _route_listeners.append(listener)
+
+
+def _routes_directly(tunnel_name: str) -> bool:
+    config = get_config()
+    return any(list_config.interface == tunnel_name
+               for list_config in itertools.chain(
+                   config.manual_domain_lists, config.external_domain_lists,
+                   config.external_ip_lists))
+
+
+def _get_group_ips(group_name: str, tunnel_name: str,
+                   routed_ips: set[str]) -> list[str]:
+    # Routes synced from the kernel or restored from a snapshot were not
+    # added by this process, so the recent routing decisions tell which of
+    # them belong to the group
+    decisions = dict.fromkeys(_group_ips.get(group_name, ()), group_name)
+    for domain, ips in _last_routed_domains:
+        for interface_name, plan_ips in \
+                _plan_routes(match_domain(domain), ips).items():
+            decisions.update(dict.fromkeys(plan_ips, interface_name))
+    undecided = [ip for ip in routed_ips if ip not in decisions]
+    for interface_name, plan_ips in _plan_routes(None, undecided).items():
+        decisions.update(dict.fromkeys(plan_ips, interface_name))
+    # A route with no known decision can only come from a group if no list
+    # uses the tunnel directly
+    if not _routes_directly(tunnel_name):
+        decisions.update(dict.fromkeys(undecided, group_name))
+    return [ip for ip in routed_ips if decisions[ip] == group_name]
+
+
+async def _move_group_routes(group: TunnelGroup,
+                             old_interface: InterfaceConfig,
+                             new_interface: InterfaceConfig):
+    # Taken when the move runs, so routes added while it was queued are
+    # included
+    ips = _get_group_ips(group.name, old_interface.name,
+                         get_routed_ips(old_interface))
+    if not ips:
+        return
+    await move_routes(old_interface, new_interface, ips)
+    _group_ips.setdefault(group.name, set()).update(ips)
+
+
+async def _on_tunnel_switch(group: TunnelGroup, old: str, new: str):
+    old_interface = iface_name_to_config.get(old)
+    new_interface = iface_name_to_config[new]
+    if old_interface is None:
+        return
+    await route_pipeline.submit(
+        PRIORITY_RESOLVE,
+        lambda: _move_group_routes(group, old_interface, new_interface))
+
+
+tunnel_health.add_listener(_on_tunnel_switch)
 
 
 async def re_route_domain(domain: str):
@@ -43,7 +218,33 @@ async def re_route_domain(domain: str):
     if ips:
         logger.debug(f'Re-routing domain %s with ips %s', domain, ips)
         domain_list = match_domain(domain)
-        await route_domain(domain_list, domain, ips)
+        await route_pipeline.submit(
+            PRIORITY_BACKGROUND,
+            lambda: _apply_route(domain_list, domain, ips))
     else:
         logger.debug(f'Domain %s was not routed before. Nothing to reroute',
                      domain)
+
+
+async def re_route_all_domains():
+    domains = list(dict.fromkeys(x[0] for x in _last_routed_domains))
+    logger.info(f'Re-routing {len(domains)} recently resolved domains')
+    for domain in domains:
+        await re_route_domain(domain)
+
+
+async def re_route_list_entry(entry: str):
+    # A pattern may match any of the recent domains
+    if is_pattern(entry):
+        await re_route_all_domains()
+    else:
+        await re_route_domain(entry)
+
+
+def dump_routed_domains() -> list:
+    return [[domain, ips] for domain, ips in _last_routed_domains]
+
+
+def load_routed_domains(routed_domains: list):
+    _last_routed_domains.extend(
+        (domain, ips) for domain, ips in routed_domains)
@@ -1,6 +1,6 @@
 import asyncio
 from enum import Enum
-from typing import Optional
+from typing import Callable, Optional
 
 from pydantic import BaseModel
 
@@ -20,13 +20,25 @@ class ResolveEvent(Event):
     domain_list: Optional[str]
 
 
+EventListener = Callable[[Event], None]
+
+
 class EventLogger:
     _event_logger_queue: asyncio.Queue
+    _listeners: list[EventListener]
+
+    def __init__(self):
+        self._listeners = []
 
     def setup(self):
         self._event_logger_queue = asyncio.Queue()
 
+    def add_listener(self, listener: EventListener):
+        self._listeners.append(listener)
+
     def _log_event(self, event: Event):
+        for listener in self._listeners:
+            listener(event)
         self._event_logger_queue.put_nowait(event.json())
 
     async def get_next_event(self):
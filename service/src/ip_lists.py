@@ -0,0 +1,128 @@
+import asyncio
+from typing import Optional
+
+import aiohttp
+
+from config import ExternalIpList, get_config
+from ip_matchers import IpPrefixTree
+from ip_route import add_prefix_routes, del_prefix_routes
+from logger import logger
+from scheduler import scheduler
+
+ip_lists: dict[str, tuple[ExternalIpList, IpPrefixTree]] = {}
+
+
+def _get_interface(list_config: ExternalIpList):
+    return next((tunnel for tunnel in get_config().networking.tunnels
+                 if tunnel.name == list_config.interface), None)
+
+
+async def _sync_prefix_routes(list_config: ExternalIpList,
+                              old_tree: Optional[IpPrefixTree],
+                              new_tree: Optional[IpPrefixTree]):
+    old_prefixes = set(old_tree.prefixes) if old_tree is not None and \
+        list_config.preinstall_routes else set()
+    new_prefixes = set(new_tree.prefixes) if new_tree is not None and \
+        list_config.preinstall_routes else set()
+    await del_prefix_routes(sorted(old_prefixes - new_prefixes))
+    if new_prefixes:
+        interface = _get_interface(list_config)
+        if interface is None:
+            logger.warning(f'IP list {list_config.name} needs a tunnel to '
+                           f'preinstall routes, not {list_config.interface}')
+            return
+        await add_prefix_routes(interface, sorted(new_prefixes))
+
+
+async def update_external_ip_list(list_config: ExternalIpList):
+    logger.info(f'Updating IP list {list_config.name}')
+    async with aiohttp.ClientSession() as session:
+        async with session.get(list_config.url) as resp:
+            assert resp.status == 200
+            lines = (await resp.text()).splitlines()
+    tree = await asyncio.get_running_loop().run_in_executor(
+        None, IpPrefixTree.build, lines)
+    _, old_tree = ip_lists.get(list_config.name, (None, None))
+    ip_lists[list_config.name] = (list_config, tree)
+    await _sync_prefix_routes(list_config, old_tree, tree)
+    logger.info(f'Updated IP list {list_config.name}: '
+                f'{len(tree)} prefixes')
+
+
+def _start_external_ip_list(list_config: ExternalIpList,
+                            initial_delay: float = 0):
+    scheduler.add(f'ip_list:{list_config.name}',
+                  lambda: update_external_ip_list(list_config),
+                  list_config.update_interval_hours * 3600, initial_delay)
+
+
+def start_external_ip_lists():
+    for list_config in get_config().external_ip_lists:
+        _start_external_ip_list(list_config)
+
+
+async def _reconfigure_prefix_routes(old_config: ExternalIpList,
+                                     new_config: ExternalIpList,
+                                     tree: Optional[IpPrefixTree]):
+    if old_config.preinstall_routes and not new_config.preinstall_routes:
+        await _sync_prefix_routes(old_config, tree, None)
+    elif new_config.preinstall_routes and \
+            (not old_config.preinstall_routes or
+             old_config.interface != new_config.interface):
+        # Replaces the routes through the old interface, if any
+        await _sync_prefix_routes(new_config, None, tree)
+
+
+async def reload_ip_lists(old_lists: list[ExternalIpList]) -> bool:
+    # Returns whether resolved IPs may be routed differently now
+    old_by_name = {c.name: c for c in old_lists}
+    changed = False
+    for list_config in get_config().external_ip_lists:
+        old_config = old_by_name.pop(list_config.name, None)
+        if old_config is not None and old_config.dict() == list_config.dict():
+            continue
+
+        if old_config is not None and old_config.url == list_config.url:
+            # The downloaded networks are still valid, routes only change
+            # with the interface or preinstall_routes
+            logger.info(f'Rescheduling IP list {list_config.name}')
+            _, tree = ip_lists.get(list_config.name, (None, None))
+            if tree is not None:
+                ip_lists[list_config.name] = (list_config, tree)
+                await _reconfigure_prefix_routes(old_config, list_config,
+                                                 tree)
+            changed |= old_config.interface != list_config.interface or \
+                old_config.preinstall_routes != list_config.preinstall_routes
+            # No need to download it again right away
+            _start_external_ip_list(
+                list_config,
+                list_config.update_interval_hours * 3600
+                if tree is not None else 0)
+            continue
+
+        if old_config is not None:
+            await _remove_ip_list(old_config)
+        logger.info(f'Adding IP list {list_config.name}')
+        changed = True
+        _start_external_ip_list(list_config)
+
+    for old_config in old_by_name.values():
+        await _remove_ip_list(old_config)
+        changed = True
+    return changed
+
+
+async def _remove_ip_list(list_config: ExternalIpList):
+    logger.info(f'Removing IP list {list_config.name}')
+    scheduler.remove(f'ip_list:{list_config.name}')
+    _, old_tree = ip_lists.pop(list_config.name, (None, None))
+    await _sync_prefix_routes(list_config, old_tree, None)
+
+
+def match_ip(ip: str) -> Optional[ExternalIpList]:
+    # In config order, not in the order the downloads finished
+    for config in get_config().external_ip_lists:
+        list_config, tree = ip_lists.get(config.name, (None, None))
+        if tree is not None and tree.longest_match(ip) is not None:
+            return list_config
+    return None
@@ -0,0 +1,67 @@
+from ipaddress import IPv4Address, IPv4Network, collapse_addresses
+from typing import Iterable, Optional
+
+from logger import logger
+
+# Trie node: [child for bit 0, child for bit 1, prefix ending here]
+Node = list
+
+
+def _parse_networks(lines: Iterable[str]) -> list[IPv4Network]:
+    networks = []
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        try:
+            networks.append(IPv4Network(line, strict=False))
+        except ValueError:
+            logger.debug(f'Skipping invalid IP list entry: {line}')
+    return list(collapse_addresses(networks))
+
+
+class IpPrefixTree:
+    _root: Node
+    _prefixes: list[str]
+
+    def __init__(self):
+        self._root = [None, None, None]
+        self._prefixes = []
+
+    @staticmethod
+    def build(lines: Iterable[str]) -> 'IpPrefixTree':
+        tree = IpPrefixTree()
+        for network in _parse_networks(lines):
+            tree._insert(network)
+        return tree
+
+    def _insert(self, network: IPv4Network):
+        node = self._root
+        address = int(network.network_address)
+        for bit in range(network.prefixlen):
+            branch = (address >> (31 - bit)) & 1
+            child = node[branch]
+            if child is None:
+                child = node[branch] = [None, None, None]
+            node = child
+        node[2] = str(network)
+        self._prefixes.append(str(network))
+
+    def longest_match(self, ip: str) -> Optional[str]:
+        address = int(IPv4Address(ip))
+        node = self._root
+        match = node[2]
+        for bit in range(32):
+            node = node[(address >> (31 - bit)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+        return match
+
+    @property
+    def prefixes(self) -> list[str]:
+        return self._prefixes
+
+    def __len__(self):
+        return len(self._prefixes)
@@ -1,22 +1,33 @@
 import asyncio
 import logging
 import re
+from typing import Optional
 
 from config import get_config, InterfaceConfig
-from scheduled import scheduled
+from scheduler import scheduler
 from logger import logger
+from route_aggregation import route_aggregator
 
 cache: dict[InterfaceConfig, set[str]] = {}
+# Routes to whole networks, e.g. preinstalled from IP lists
+prefix_cache: dict[InterfaceConfig, set[str]] = {}
+# Host routes via the default gateway, for IPs that a prefix route would
+# otherwise send through a tunnel
+default_routes: set[str] = set()
+# Where the default route goes, e.g. ['via', '192.168.1.1', 'dev', 'eth0']
+default_gateway: list[str] = []
 
 
-async def exec_command(*args):
+async def exec_command(*args, input: Optional[str] = None):
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug(f'Executing command: {" ".join(args)}')
     proc = await asyncio.create_subprocess_exec(
         *args,
+        stdin=asyncio.subprocess.PIPE if input is not None else None,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE)
-    stdout, stderr = await proc.communicate()
+    stdout, stderr = await proc.communicate(
+        input.encode() if input is not None else None)
     if stderr:
         logger.info(
             f'Command `{" ".join(args)}` failed with error: {stderr.decode()}')
@@ -28,23 +39,155 @@ async def ip_route(*args):
     return await exec_command(*command, *args)
 
 
+async def ip_route_batch(commands: list[list[str]]):
+    command = get_config().ip_route_command.split(' ')
+    if command[-1] != 'route':
+        for args in commands:
+            await ip_route(*args)
+        return
+    # `ip -batch` applies thousands of routes in one process instead of
+    # spawning `sudo ip` for each of them
+    await exec_command(
+        *command[:-1], '-force', '-batch', '-',
+        input=''.join(f'route {" ".join(args)}\n' for args in commands))
+
+
+async def add_prefix_routes(interface: InterfaceConfig,
+                            prefixes: list[str]):
+    interface_prefixes = prefix_cache.setdefault(interface, set())
+    prefixes = [prefix for prefix in prefixes
+                if prefix not in interface_prefixes]
+    if not prefixes:
+        return
+    await ip_route_batch([['replace', prefix, 'via', interface.gateway_ip]
+                          for prefix in prefixes])
+    for other_prefixes in prefix_cache.values():
+        other_prefixes.difference_update(prefixes)
+    interface_prefixes.update(prefixes)
+    if route_aggregator.enabled:
+        # Aggregated routes must not take addresses from the new prefixes
+        await _rebalance_aggregates(route_aggregator.aggregated_prefixes())
+    await flush_cache()
+    logger.info(f'Installed {len(prefixes)} prefix routes '
+                f'via {interface.name}')
+
+
+async def del_prefix_routes(prefixes: list[str]):
+    prefixes = [prefix for prefix in prefixes
+                if any(prefix in cache_prefixes
+                       for cache_prefixes in prefix_cache.values())]
+    if not prefixes:
+        return
+    await ip_route_batch([['del', prefix] for prefix in prefixes])
+    for cache_prefixes in prefix_cache.values():
+        cache_prefixes.difference_update(prefixes)
+    await flush_cache()
+    logger.info(f'Removed {len(prefixes)} prefix routes')
+
+
+def has_routes(interface: Optional[InterfaceConfig], ips: list[str]) -> bool:
+    if interface is None:
+        # An aggregated prefix route sends the IPs through a tunnel as well
+        return not any(ip in cache_ips
+                       for cache_ips in cache.values() for ip in ips) and \
+            not any(ip in default_routes for ip in ips) and \
+            not (route_aggregator.enabled and
+                 any(route_aggregator.is_aggregated(ip) for ip in ips))
+    interface_ips = cache.get(interface, ())
+    return all(ip in interface_ips for ip in ips)
+
+
+def get_routed_ips(interface: InterfaceConfig) -> set[str]:
+    return set(cache.get(interface, ()))
+
+
+def note_default_routes(ips: list[str]):
+    # Also for IPs that need no route changes, so their prefixes are not
+    # aggregated later
+    if route_aggregator.enabled:
+        for ip in ips:
+            route_aggregator.note_default(ip)
+
+
+def has_default_routes(ips: list[str]) -> bool:
+    return all(ip in default_routes for ip in ips)
+
+
+def _parse_default_gateway(routes: str) -> Optional[list[str]]:
+    for route in routes.splitlines():
+        values = re.match(r'default (?:via (\S+) )?dev (\S+)', route)
+        if values is not None:
+            gateway_ip, device = values.groups()
+            return (['via', gateway_ip] if gateway_ip else []) + \
+                ['dev', device]
+    return None
+
+
+async def add_default_routes(ips: list[str]):
+    global default_gateway
+    ips = [ip for ip in ips if ip not in default_routes]
+    if not ips:
+        return
+    if not default_gateway:
+        default_gateway = _parse_default_gateway(
+            await ip_route('show', 'default')) or []
+    if not default_gateway:
+        logger.warning(f'No default route to add routes to {ips} via')
+        return
+    await ip_route_batch([['replace', ip, *default_gateway] for ip in ips])
+    default_routes.update(ips)
+    await del_route(ips, replaced=True)
+
+
+async def _rebalance_aggregates(prefixes: set[int]) -> bool:
+    commands = route_aggregator.rebalance(prefixes, prefix_cache)
+    if commands:
+        await ip_route_batch(commands)
+    return bool(commands)
+
+
 async def add_route(interface: InterfaceConfig, ips: list[str]):
     dirty = False
+    aggregation = route_aggregator.enabled
+    prefixes = set()
+    interface_ips = cache.setdefault(interface, set())
     for ip in ips:
-        if ip in cache[interface]:
+        if ip in interface_ips:
             continue
         dirty = True
-        cache[interface].add(ip)
-        await ip_route('add', ip, 'via', interface.gateway_ip)
+        interface_ips.add(ip)
+        replaced = ip in default_routes
+        default_routes.discard(ip)
+        if aggregation:
+            prefixes.add(route_aggregator.note_routed(interface, ip))
+            if route_aggregator.covers(interface, ip):
+                if replaced:
+                    await ip_route('del', ip)
+                continue
+        await ip_route('replace' if replaced else 'add', ip,
+                       'via', interface.gateway_ip)
+    if aggregation:
+        await _rebalance_aggregates(prefixes)
     if dirty:
         await flush_cache()
     else:
         logger.debug(f'Route for {ips} already exists. Nothing to add')
 
 
-async def del_route(ips: list[str]):
-    dirty = False
+async def del_route(ips: list[str], replaced: bool = False):
+    # replaced: the host routes were already replaced by routes via the
+    # default gateway, only the cache is updated
+    dirty = replaced
+    aggregation = route_aggregator.enabled
+    prefixes = set()
     for ip in ips:
+        if aggregation:
+            prefixes.add(route_aggregator.note_default(ip))
+        if ip in default_routes and not replaced:
+            default_routes.remove(ip)
+            dirty = True
+            await ip_route('del', ip)
+            continue
         for interface, cache_ips in cache.items():
             if ip in cache_ips:
                 break
@@ -52,13 +195,62 @@ async def del_route(ips: list[str]):
             continue
         dirty = True
         cache[interface].remove(ip)
-        await ip_route('del', ip)
+        if aggregation:
+            prefixes.add(route_aggregator.note_unrouted(interface, ip))
+            if route_aggregator.covers(interface, ip):
+                continue
+        if not replaced:
+            await ip_route('del', ip)
+    if aggregation:
+        dirty |= await _rebalance_aggregates(prefixes)
     if dirty:
         await flush_cache()
     else:
         logger.debug(f'No route for {ips}. Nothing to remove')
 
 
+async def move_routes(old_interface: InterfaceConfig,
+                      new_interface: InterfaceConfig, ips: list[str]):
+    old_ips = cache.get(old_interface, set())
+    new_ips = cache.setdefault(new_interface, set())
+    aggregation = route_aggregator.enabled
+    prefixes = set()
+    commands = []
+    for ip in ips:
+        if ip not in old_ips:
+            continue
+        old_ips.remove(ip)
+        new_ips.add(ip)
+        if not aggregation:
+            commands.append(['replace', ip, 'via', new_interface.gateway_ip])
+            continue
+        had_host_route = not route_aggregator.covers(old_interface, ip)
+        route_aggregator.note_unrouted(old_interface, ip)
+        prefixes.add(route_aggregator.note_routed(new_interface, ip))
+        if not route_aggregator.covers(new_interface, ip):
+            commands.append(['replace', ip, 'via', new_interface.gateway_ip])
+        elif had_host_route:
+            commands.append(['del', ip])
+    if commands:
+        await ip_route_batch(commands)
+    if aggregation:
+        await _rebalance_aggregates(prefixes)
+    if commands or prefixes:
+        await flush_cache()
+    logger.info(f'Moved {len(commands)} routes from {old_interface.name} '
+                f'to {new_interface.name}')
+
+
+async def reload_tunnels(old_tunnels: list[InterfaceConfig],
+                         new_tunnels: list[InterfaceConfig]):
+    for interface in set(old_tunnels) - set(new_tunnels):
+        logger.info(f'Removing routes via dropped tunnel {interface.name}')
+        await del_route(list(cache.get(interface, ())))
+        cache.pop(interface, None)
+    for interface in new_tunnels:
+        cache.setdefault(interface, set())
+
+
 async def get_routes():
     return await ip_route('show')
 
@@ -67,22 +259,29 @@ async def flush_cache():
     await ip_route('flush', 'cache')
 
 
-@scheduled(60)
+SYNC_INTERVAL = 60
+
+
 async def sync_ip_route_cache():
     logger.info('Syncing ip route cache')
-    global cache
+    global cache, prefix_cache, default_routes, default_gateway
     gateway_ips_to_iface_configs = {
         config.gateway_ip: config for config in get_config().networking.tunnels
     }
     cache = {
         config: set() for config in gateway_ips_to_iface_configs.values()
     }
+    prefix_cache = {
+        config: set() for config in gateway_ips_to_iface_configs.values()
+    }
 
     actual_routes_by_gateway = {}
 
-    for route in (await get_routes()).splitlines():
-        values = re.match(r'(\d+\.\d+\.\d+\.\d+).*via (\d+\.\d+\.\d+\.\d+)',
-                          route)
+    routes = await get_routes()
+    default_gateway = _parse_default_gateway(routes) or []
+    for route in routes.splitlines():
+        values = re.match(
+            r'(\d+\.\d+\.\d+\.\d+(?:/\d+)?).*via (\d+\.\d+\.\d+\.\d+)', route)
         if values is None:
             continue
         ip, gateway_ip = values.groups()
@@ -92,4 +291,38 @@ async def sync_ip_route_cache():
         iface_config = gateway_ips_to_iface_configs.get(gateway_ip)
         if iface_config is None:
             continue
-        cache[iface_config] = ips
+        cache[iface_config] = {ip for ip in ips if '/' not in ip}
+        prefix_cache[iface_config] = {ip for ip in ips if '/' in ip}
+    # Routes via a gateway can be checked, routes to a device are trusted
+    if default_gateway[:1] == ['via']:
+        default_routes = default_routes & \
+            actual_routes_by_gateway.get(default_gateway[1], set())
+
+    if route_aggregator.enabled:
+        route_aggregator.rebuild(cache, prefix_cache)
+
+
+def start_ip_route_cache_sync(initial_delay: float = 0) -> asyncio.Task:
+    return scheduler.add('ip_route_sync', sync_ip_route_cache, SYNC_INTERVAL,
+                         initial_delay)
+
+
+def dump_aggregated_routes() -> list:
+    return route_aggregator.dump()
+
+
+def dump_cache() -> list:
+    return [[interface.name, interface.gateway_ip, sorted(ips)]
+            for interface, ips in cache.items()]
+
+
+def load_cache(routes: list, aggregated: list):
+    tunnels = {(config.name, config.gateway_ip): config
+               for config in get_config().networking.tunnels}
+    for config in tunnels.values():
+        cache.setdefault(config, set())
+    for name, gateway_ip, ips in routes:
+        config = tunnels.get((name, gateway_ip))
+        if config is not None:
+            cache[config].update(ips)
+    route_aggregator.load(aggregated, cache)
@@ -4,12 +4,23 @@ import sys
 from config import get_config
 
 
+_handlers: dict[str, logging.Handler] = {}
+
+
 def init_logging():
-    for logger_name, level in get_config().loggers.items():
+    levels = get_config().loggers
+    for logger_name in set(_handlers) - set(levels):
+        logging.getLogger(logger_name).removeHandler(_handlers.pop(logger_name))
+        logging.getLogger(logger_name).setLevel(logging.NOTSET)
+
+    for logger_name, level in levels.items():
+        handler = _handlers.get(logger_name)
+        if handler is None:
+            handler = logging.StreamHandler(sys.stdout)
+            logging.getLogger(logger_name).addHandler(handler)
+            _handlers[logger_name] = handler
         logging.getLogger(logger_name).setLevel(level)
-        handler = logging.StreamHandler(sys.stdout)
         handler.setLevel(level)
-        logging.getLogger(logger_name).addHandler(handler)
 
 
 logger = logging.getLogger('freeroute')
@@ -3,45 +3,63 @@ import signal
 
 from aiodnsresolver import IPv4AddressExpiresAt
 
+from config_reload import reload
 from dns_proxy import (
     DnsProxy
 )
-from domain_lists import init_external_domain_lists, match_domain, \
+from domain_lists import start_external_domain_lists, match_domain, \
     init_manual_domain_lists
 from domain_router import route_domain
 from event_logger import event_logger
-from ip_route import sync_ip_route_cache
+from ip_lists import start_external_ip_lists
+from ip_route import start_ip_route_cache_sync, SYNC_INTERVAL
 from logger import init_logging
+from profiling import query_profiler
+from query_trace import trace_writer
+from replication import start_replication, stop_replication
+from route_pipeline import route_pipeline
+from runtime_state import load_snapshot, save_snapshot, \
+    start_periodic_snapshots
+from static_answers import static_answers
+from tunnel_health import start_tunnel_probing
 from web_server import setup_web_server, event_source_handler
 
 init_logging()
 
 
 async def on_resolve(addr: str, domain: str, ips: list[IPv4AddressExpiresAt]):
-    domain_list = match_domain(domain)
+    with query_profiler.span('match'):
+        domain_list = match_domain(domain)
     ips_str = [str(ip) for ip in ips]
 
     event_logger.log_resolve_event(addr[0], domain, ips_str,
                                    domain_list.name if domain_list else None)
-    await route_domain(domain_list, domain, ips_str)
+    with query_profiler.span('route'):
+        await route_domain(domain_list, domain, ips_str)
 
 
 async def async_main():
     tasks = set()
 
+    static_answers.load()
+    await init_manual_domain_lists()
+
+    await start_external_domain_lists()
+    start_external_ip_lists()
+
+    routes_restored = await load_snapshot()
+
+    tasks.add(route_pipeline.start())
+    await start_replication()
+
     start = DnsProxy(resolved_callback=on_resolve)
     proxy_task = await start()
     tasks.add(proxy_task)
 
-    await init_manual_domain_lists()
-
-    external_domain_list_tasks = init_external_domain_lists()
-    for task in external_domain_list_tasks:
-        tasks.add(
-            asyncio.create_task(task()))
-
-    tasks.add(
-        asyncio.create_task(sync_ip_route_cache()))
+    tasks.add(start_ip_route_cache_sync(
+        initial_delay=SYNC_INTERVAL if routes_restored else 0))
+    tasks.add(start_periodic_snapshots())
+    tasks.add(start_tunnel_probing())
 
     tasks.add(
         asyncio.create_task(event_source_handler.event_log_listener_task()))
@@ -50,6 +68,8 @@ async def async_main():
     loop = asyncio.get_running_loop()
     loop.add_signal_handler(signal.SIGINT, proxy_task.cancel)
     loop.add_signal_handler(signal.SIGTERM, proxy_task.cancel)
+    loop.add_signal_handler(signal.SIGHUP,
+                            lambda: asyncio.create_task(reload()))
 
     await setup_web_server()
 
@@ -58,6 +78,10 @@ async def async_main():
     except asyncio.CancelledError:
         pass
 
+    trace_writer.stop()
+    await stop_replication()
+    await save_snapshot()
+
 
 if __name__ == '__main__':
     asyncio.run(async_main())
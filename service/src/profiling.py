@@ -0,0 +1,218 @@
+import random
+import signal
+import time
+import tracemalloc
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Optional, Deque
+
+from config import get_config
+from logger import logger
+
+
+class QueryTrace:
+    __slots__ = ('domain', 'started_at', 'spans')
+
+    def __init__(self):
+        self.domain: Optional[str] = None
+        self.started_at = time.perf_counter()
+        self.spans: dict[str, float] = {}
+
+
+_current_trace: ContextVar[Optional[QueryTrace]] = ContextVar(
+    'query_trace', default=None)
+
+
+class StageStats:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'avg_ms': self.total / self.count * 1000 if self.count else 0.0,
+            'max_ms': self.max * 1000,
+        }
+
+
+class QueryProfiler:
+    _stages: dict[str, StageStats]
+    _slow_queries: Deque[dict]
+
+    def __init__(self):
+        self._stages = {}
+        self._slow_queries = deque(
+            maxlen=get_config().profiling.slow_query_log_size)
+
+    def begin_query(self) -> Token:
+        sampled = random.random() < get_config().profiling.sample_rate
+        return _current_trace.set(QueryTrace() if sampled else None)
+
+    def end_query(self, token: Token):
+        trace = _current_trace.get()
+        _current_trace.reset(token)
+        if trace is None:
+            return
+
+        total = time.perf_counter() - trace.started_at
+        self._add_stage('total', total)
+        for name, duration in trace.spans.items():
+            self._add_stage(name, duration)
+
+        if total * 1000 >= get_config().profiling.slow_query_ms:
+            self._slow_queries.append({
+                'time': time.time(),
+                'domain': trace.domain,
+                'total_ms': total * 1000,
+                'spans_ms': {name: duration * 1000
+                             for name, duration in trace.spans.items()},
+            })
+
+    def set_domain(self, domain: str):
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.domain = domain
+
+    @contextmanager
+    def span(self, name: str):
+        trace = _current_trace.get()
+        if trace is None:
+            yield
+            return
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            trace.spans[name] = trace.spans.get(name, 0.0) + \
+                                time.perf_counter() - started_at
+
+    def _add_stage(self, name: str, duration: float):
+        stats = self._stages.get(name)
+        if stats is None:
+            stats = self._stages[name] = StageStats()
+        stats.add(duration)
+
+    def get_stats(self):
+        return {name: stats.as_dict() for name, stats in self._stages.items()}
+
+    def get_slow_queries(self):
+        return list(reversed(self._slow_queries))
+
+    def reset(self):
+        self._stages.clear()
+        self._slow_queries.clear()
+
+
+class CpuSampler:
+    MAX_STACK_DEPTH = 40
+
+    _stacks: Counter
+    _running: bool
+
+    def __init__(self):
+        self._stacks = Counter()
+        self._running = False
+        self._started_at = 0.0
+
+    @property
+    def running(self):
+        return self._running
+
+    def _on_sample(self, signum, frame):
+        stack = []
+        while frame is not None and len(stack) < self.MAX_STACK_DEPTH:
+            code = frame.f_code
+            stack.append(
+                f'{code.co_filename}:{code.co_name}:{frame.f_lineno}')
+            frame = frame.f_back
+        self._stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        if self._running:
+            return
+        interval = get_config().profiling.cpu_sample_interval_ms / 1000
+        self._stacks.clear()
+        self._started_at = time.time()
+        signal.signal(signal.SIGPROF, self._on_sample)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        self._running = True
+        logger.info('CPU sampling profiler started')
+
+    def stop(self, limit: int = 30):
+        if self._running:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+            self._running = False
+            logger.info('CPU sampling profiler stopped')
+
+        self_samples = Counter()
+        for stack, count in self._stacks.items():
+            self_samples[stack[-1]] += count
+
+        return {
+            'duration_seconds': time.time() - self._started_at,
+            'samples': sum(self._stacks.values()),
+            'top_functions': [
+                {'location': location, 'samples': count}
+                for location, count in self_samples.most_common(limit)],
+            'top_stacks': [
+                {'stack': ';'.join(stack), 'samples': count}
+                for stack, count in self._stacks.most_common(limit)],
+        }
+
+
+class MemoryProfiler:
+    _previous: Optional[tracemalloc.Snapshot]
+
+    def __init__(self):
+        self._previous = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            logger.info('tracemalloc started')
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            logger.info('tracemalloc stopped')
+        self._previous = None
+
+    def snapshot(self, limit: int = 30):
+        self.start()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            'traced_kb': current / 1024,
+            'peak_kb': peak / 1024,
+            'top': [
+                {'location': str(stat.traceback), 'size_kb': stat.size / 1024,
+                 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:limit]],
+        }
+        if self._previous is not None:
+            result['diff'] = [
+                {'location': str(stat.traceback),
+                 'size_diff_kb': stat.size_diff / 1024,
+                 'count_diff': stat.count_diff}
+                for stat in snapshot.compare_to(self._previous,
+                                                'lineno')[:limit]]
+        self._previous = snapshot
+        return result
+
+
+query_profiler = QueryProfiler()
+cpu_sampler = CpuSampler()
+memory_profiler = MemoryProfiler()
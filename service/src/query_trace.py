@@ -0,0 +1,91 @@
+import socket
+import struct
+import time
+from typing import BinaryIO, Iterator, NamedTuple, Optional
+
+from config import get_config
+from dns_wire import parse_question
+from logger import logger
+
+# Trace file: MAGIC, then one record per query: milliseconds since the start
+# of the capture, client IPv4 address, qtype, name length and the name
+MAGIC = b'FRQT\x01'
+RECORD = struct.Struct('!I4sHB')
+
+
+class TracedQuery(NamedTuple):
+    offset: float
+    client: str
+    name: bytes
+    qtype: int
+
+
+class TraceWriter:
+    _file: Optional[BinaryIO]
+    _started_at: float
+    _max_queries: int
+    queries: int
+
+    def __init__(self):
+        self._file = None
+        self._started_at = 0
+        self._max_queries = 0
+        self.queries = 0
+
+    @property
+    def active(self) -> bool:
+        return self._file is not None
+
+    def start(self):
+        config = get_config().trace_capture
+        self.stop()
+        self._file = open(config.file, 'wb', buffering=64 * 1024)
+        self._file.write(MAGIC)
+        self._started_at = time.monotonic()
+        self._max_queries = config.max_queries
+        self.queries = 0
+        logger.info(f'Capturing queries to {config.file}')
+
+    def stop(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        logger.info(f'Captured {self.queries} queries')
+
+    def record(self, client: str, request_data: bytes):
+        if self._file is None:
+            return
+        question = parse_question(request_data)
+        if question is None or len(question.name) > 255:
+            return
+        offset = int((time.monotonic() - self._started_at) * 1000)
+        self._file.write(RECORD.pack(offset, socket.inet_aton(client),
+                                     question.qtype, len(question.name)) +
+                         question.name)
+        self.queries += 1
+        if self.queries >= self._max_queries:
+            self.stop()
+
+    def get_status(self):
+        return {
+            'active': self.active,
+            'file': get_config().trace_capture.file,
+            'queries': self.queries,
+        }
+
+
+def read_trace(file_name: str) -> Iterator[TracedQuery]:
+    with open(file_name, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{file_name} is not a query trace')
+        while True:
+            record = file.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            offset, client, qtype, length = RECORD.unpack(record)
+            yield TracedQuery(offset / 1000, socket.inet_ntoa(client),
+                              file.read(length), qtype)
+
+
+trace_writer = TraceWriter()
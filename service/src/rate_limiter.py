@@ -0,0 +1,33 @@
+from collections import OrderedDict
+
+from config import get_config
+
+
+class RateLimiter:
+    # Token bucket per client address. The least recently seen clients are
+    # forgotten first, so memory stays bounded with many clients
+    _buckets: OrderedDict[str, list[float]]
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+
+    def allow(self, client: str, now: float) -> bool:
+        limits = get_config().networking.dns_limits
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = [float(limits.client_burst), now]
+            if len(self._buckets) > limits.max_tracked_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+            refill = (now - bucket[1]) * limits.client_queries_per_second
+            bucket[0] = min(float(limits.client_burst), bucket[0] + refill)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def __len__(self):
+        return len(self._buckets)
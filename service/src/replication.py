@@ -0,0 +1,349 @@
+import asyncio
+import json
+import uuid
+from collections import deque
+from ipaddress import ip_address
+from typing import Deque, Optional
+
+from config import get_config, DomainList
+from domain_lists import add_edit_listener, get_manual_domain_lists, \
+    get_domain_matcher, match_domain
+from domain_router import add_route_listener, dump_routed_domains, \
+    load_routed_domains, re_route_all_domains, re_route_list_entry, \
+    route_domain
+from logger import logger
+
+# Protocol: one JSON message per line. A standby node connects and sends
+# hello with the epoch and sequence number of the last change it applied.
+# If the active node still has the following changes in its log, it sends
+# just those, otherwise a snapshot of the manual lists and recent routing
+# decisions. Then every change is sent as it happens, with pings in between
+# so a dead connection is noticed.
+HEARTBEAT_SECONDS = 10
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+MIN_BACKOFF_SECONDS = 0.5
+PEER_QUEUE_SIZE = 10000
+
+
+def _is_loopback(host: str) -> bool:
+    try:
+        return ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+def _encode(message: dict) -> bytes:
+    return json.dumps(message, separators=(',', ':')).encode() + b'\n'
+
+
+class ReplicationSource:
+    epoch: str
+    seq: int
+    _log: Deque[dict]
+    # Queues of messages for connected standby nodes, None to disconnect,
+    # and the tasks sending them
+    _peers: dict[asyncio.StreamWriter, tuple[asyncio.Queue, asyncio.Task]]
+
+    def __init__(self):
+        # A new epoch on every start, the log does not survive a restart
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self._log = deque()
+        self._peers = {}
+        self._server = None
+        self._heartbeat_task = None
+
+    @property
+    def running(self) -> bool:
+        return self._server is not None
+
+    async def start(self):
+        config = get_config().replication
+        if config.token is None and not _is_loopback(config.listen_host):
+            logger.warning(f'Replication on {config.listen_host} needs '
+                           f'replication.token, not starting it')
+            return
+        self._log = deque(self._log, maxlen=config.log_size)
+        self._server = await asyncio.start_server(
+            self._handle_peer, config.listen_host, config.port,
+            limit=MAX_MESSAGE_SIZE)
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        logger.info(f'Replicating to standby nodes on port {config.port}')
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._heartbeat_task.cancel()
+        self._server.close()
+        for queue, _ in self._peers.values():
+            queue.put_nowait(None)
+        await self._server.wait_closed()
+        self._server = None
+
+    def publish(self, change: dict):
+        self.seq += 1
+        message = {'type': 'change', 'seq': self.seq, **change}
+        self._log.append(message)
+        self._send(_encode(message))
+
+    def _send(self, data: bytes):
+        for writer, (queue, task) in list(self._peers.items()):
+            if queue.qsize() >= PEER_QUEUE_SIZE:
+                # Faster to start it over with a snapshot than to buffer
+                # without a bound. The sending task closes the connection
+                logger.warning('Standby node is too slow, disconnecting it')
+                del self._peers[writer]
+                task.cancel()
+            else:
+                queue.put_nowait(data)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            self._send(_encode({'type': 'ping'}))
+
+    def _catch_up(self, hello: dict) -> list[dict]:
+        first_logged = self._log[0]['seq'] if self._log else self.seq + 1
+        if hello.get('epoch') == self.epoch and \
+                first_logged - 1 <= hello.get('seq', -1) <= self.seq:
+            return [message for message in self._log
+                    if message['seq'] > hello['seq']]
+        return [{
+            'type': 'snapshot',
+            'epoch': self.epoch,
+            'seq': self.seq,
+            'lists': {
+                name: get_domain_matcher(list_config).get_all()
+                for name, list_config in get_manual_domain_lists().items()
+            },
+            'routed_domains': dump_routed_domains(),
+        }]
+
+    async def _handle_peer(self, reader: asyncio.StreamReader,
+                           writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername')
+        try:
+            hello = json.loads(await asyncio.wait_for(reader.readline(),
+                                                      HEARTBEAT_SECONDS))
+            token = get_config().replication.token
+            if hello.get('type') != 'hello' or \
+                    token is not None and hello.get('token') != token:
+                logger.warning(f'Rejected replication peer {peer}')
+                writer.write(_encode({'type': 'error',
+                                      'message': 'not authorized'}))
+                return
+
+            queue = asyncio.Queue()
+            # No await between taking the catch-up messages and adding the
+            # queue, so no change is missed or sent twice
+            for message in self._catch_up(hello):
+                writer.write(_encode(message))
+            self._peers[writer] = (queue, asyncio.current_task())
+            logger.info(f'Standby node {peer} connected')
+            await writer.drain()
+            while True:
+                data = await queue.get()
+                if data is None:
+                    return
+                writer.write(data)
+                await writer.drain()
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            logger.info(f'Standby node {peer} disconnected: {e!r}')
+        except asyncio.CancelledError:
+            # Disconnected for being too slow
+            pass
+        finally:
+            self._peers.pop(writer, None)
+            writer.close()
+
+    def get_status(self):
+        return {
+            'epoch': self.epoch,
+            'seq': self.seq,
+            'logged': len(self._log),
+            'standby_nodes': [str(writer.get_extra_info('peername'))
+                              for writer in self._peers],
+        }
+
+
+class ReplicationClient:
+    epoch: Optional[str]
+    seq: int
+    connected: bool
+
+    def __init__(self):
+        self.epoch = None
+        self.seq = 0
+        self.connected = False
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        config = get_config().replication
+        backoff = MIN_BACKOFF_SECONDS
+        while True:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(config.peer_host, config.port,
+                                            limit=MAX_MESSAGE_SIZE),
+                    HEARTBEAT_SECONDS)
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning(f'Failed to connect to active node '
+                               f'{config.peer_host}: {e!r}, retrying in '
+                               f'{backoff}s')
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, config.max_backoff_seconds)
+                continue
+
+            logger.info(f'Connected to active node {config.peer_host}')
+            self.connected = True
+            try:
+                writer.write(_encode({'type': 'hello', 'token': config.token,
+                                      'epoch': self.epoch, 'seq': self.seq}))
+                while True:
+                    line = await asyncio.wait_for(reader.readline(),
+                                                  HEARTBEAT_SECONDS * 3)
+                    if not line:
+                        raise ConnectionError('closed by active node')
+                    await self._apply(json.loads(line))
+                    backoff = MIN_BACKOFF_SECONDS
+            except (OSError, ValueError, asyncio.TimeoutError) as e:
+                logger.warning(f'Replication from {config.peer_host} '
+                               f'stopped: {e!r}, reconnecting in {backoff}s')
+            except Exception:  # noqa
+                # E.g. a message in an unexpected format. Whatever was
+                # applied of it, a snapshot brings the node back in sync
+                logger.exception(f'Failed to apply replicated change, '
+                                 f'reconnecting in {backoff}s')
+                self.epoch = None
+            finally:
+                self.connected = False
+                writer.close()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, config.max_backoff_seconds)
+
+    async def _apply(self, message: dict):
+        if message['type'] == 'snapshot':
+            await self._apply_snapshot(message)
+            self.epoch = message['epoch']
+            self.seq = message['seq']
+            logger.info(f'Applied replication snapshot at {self.seq}')
+        elif message['type'] == 'change':
+            if message['seq'] != self.seq + 1:
+                # Start over with a snapshot
+                self.epoch = None
+                raise ValueError(f'expected change {self.seq + 1}, '
+                                 f'got {message["seq"]}')
+            await self._apply_change(message)
+            self.seq = message['seq']
+        elif message['type'] == 'error':
+            raise ValueError(message['message'])
+
+    @staticmethod
+    def _get_list(name: str) -> Optional[DomainList]:
+        list_config = get_manual_domain_lists().get(name)
+        if list_config is None:
+            logger.warning(f'Replicated list {name} is not configured here')
+        return list_config
+
+    async def _apply_snapshot(self, message: dict):
+        for name, domains in message['lists'].items():
+            list_config = self._get_list(name)
+            if list_config is not None:
+                await get_domain_matcher(list_config).update(domains)
+        load_routed_domains(message['routed_domains'])
+        await re_route_all_domains()
+
+    async def _apply_change(self, message: dict):
+        if message['kind'] == 'route':
+            domain = message['domain']
+            await route_domain(match_domain(domain), domain, message['ips'])
+            return
+
+        list_config = self._get_list(message['list'])
+        if list_config is None:
+            return
+        matcher = get_domain_matcher(list_config)
+        action = message['action']
+        if action == 'update':
+            await matcher.update(message['domains'])
+            await re_route_all_domains()
+            return
+        for domain in message['domains']:
+            if action == 'add':
+                await matcher.add(domain)
+            else:
+                await matcher.remove(domain)
+            await re_route_list_entry(domain)
+
+    def get_status(self):
+        return {
+            'peer_host': get_config().replication.peer_host,
+            'connected': self.connected,
+            'epoch': self.epoch,
+            'seq': self.seq,
+        }
+
+
+replication_source = ReplicationSource()
+replication_client = ReplicationClient()
+
+
+def _on_list_edited(list_config: DomainList, action: str,
+                    domains: list[str]):
+    if replication_source.running:
+        replication_source.publish({'kind': 'list', 'list': list_config.name,
+                                    'action': action, 'domains': domains})
+
+
+def _on_routed(domain: str, ips: list[str]):
+    if replication_source.running:
+        replication_source.publish({'kind': 'route', 'domain': domain,
+                                    'ips': ips})
+
+
+add_edit_listener(_on_list_edited)
+add_route_listener(_on_routed)
+
+
+async def start_replication():
+    config = get_config().replication
+    if config.role == 'active':
+        await replication_source.start()
+    elif config.role == 'standby':
+        if config.peer_host is None:
+            logger.warning('Standby replication needs replication.peer_host')
+            return
+        replication_client.start()
+
+
+async def stop_replication():
+    await replication_source.stop()
+    await replication_client.stop()
+
+
+def get_replication_status():
+    config = get_config().replication
+    return {
+        'role': config.role,
+        'active': replication_source.get_status()
+        if replication_source.running else None,
+        'standby': replication_client.get_status()
+        if replication_client.running else None,
+    }
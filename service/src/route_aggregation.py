@@ -0,0 +1,208 @@
+import time
+from ipaddress import IPv4Address, IPv4Network
+from typing import Iterable, Optional
+
+from config import get_config, InterfaceConfig
+from logger import logger
+
+# Host routes through a tunnel are tracked per covering prefix. Once enough
+# of a prefix is routed through one tunnel, the host routes are replaced by
+# a single route for the prefix. A prefix is never aggregated while some IP
+# in it is known to go via the default route, since the covering route
+# would capture it, and an aggregated prefix is split back as soon as one
+# of its IPs is resolved for the default route. Host routes through other
+# tunnels are more specific and keep working.
+#
+# Invariant: a routed IP has a host route in the kernel unless its prefix is
+# aggregated through the same tunnel.
+
+
+class RouteAggregator:
+    _members: dict[int, dict[InterfaceConfig, set[str]]]
+    # IPs last resolved for the default route, with when that was
+    _defaults: dict[int, dict[str, float]]
+    _aggregated: dict[int, InterfaceConfig]
+
+    def __init__(self):
+        self._members = {}
+        self._defaults = {}
+        self._aggregated = {}
+
+    @property
+    def enabled(self) -> bool:
+        return get_config().route_aggregation.enabled
+
+    @staticmethod
+    def _prefix_length() -> int:
+        return get_config().route_aggregation.prefix_length
+
+    def prefix_of(self, ip: str) -> int:
+        return int(IPv4Address(ip)) >> (32 - self._prefix_length())
+
+    def _network(self, prefix: int) -> str:
+        length = self._prefix_length()
+        return str(IPv4Network((prefix << (32 - length), length)))
+
+    def _threshold(self) -> int:
+        config = get_config().route_aggregation
+        return max(2, round(config.min_density *
+                            2 ** (32 - config.prefix_length)))
+
+    def covers(self, interface: InterfaceConfig, ip: str) -> bool:
+        return self._aggregated.get(self.prefix_of(ip)) == interface
+
+    def is_aggregated(self, ip: str) -> bool:
+        return self.prefix_of(ip) in self._aggregated
+
+    def note_routed(self, interface: InterfaceConfig, ip: str) -> int:
+        prefix = self.prefix_of(ip)
+        self._members.setdefault(prefix, {}) \
+            .setdefault(interface, set()).add(ip)
+        defaults = self._defaults.get(prefix)
+        if defaults is not None:
+            defaults.pop(ip, None)
+            if not defaults:
+                del self._defaults[prefix]
+        return prefix
+
+    def note_unrouted(self, interface: InterfaceConfig, ip: str) -> int:
+        prefix = self.prefix_of(ip)
+        members = self._members.get(prefix, {})
+        members.get(interface, set()).discard(ip)
+        if members and not any(members.values()):
+            del self._members[prefix]
+        return prefix
+
+    def note_default(self, ip: str) -> int:
+        # Kept even for prefixes without routed IPs, they may get some later
+        prefix = self.prefix_of(ip)
+        self._defaults.setdefault(prefix, {})[ip] = time.monotonic()
+        return prefix
+
+    def _expire_defaults(self):
+        # Forgotten IPs are safe: resolving one again for the default route
+        # splits an aggregated prefix covering it
+        expired_before = time.monotonic() - \
+            get_config().route_aggregation.default_ip_memory_minutes * 60
+        for prefix, ips in list(self._defaults.items()):
+            for ip in [ip for ip, seen in ips.items()
+                       if seen < expired_before]:
+                del ips[ip]
+            if not ips:
+                del self._defaults[prefix]
+
+    def _covered_by_prefix_route(
+            self, prefix: int, interface: InterfaceConfig,
+            prefix_cache: dict[InterfaceConfig, set[str]]) -> bool:
+        # A prefix route through another tunnel, e.g. preinstalled from an
+        # IP list, that the aggregated route would take addresses from. More
+        # specific prefix routes keep working
+        length = self._prefix_length()
+        address = prefix << (32 - length)
+        networks = {str(IPv4Network((address, supernet_length), strict=False))
+                    for supernet_length in range(length + 1)}
+        return any(not networks.isdisjoint(prefixes)
+                   for other, prefixes in prefix_cache.items()
+                   if other != interface)
+
+    def _desired(self, prefix: int,
+                 prefix_cache: dict[InterfaceConfig, set[str]]) \
+            -> Optional[InterfaceConfig]:
+        if self._defaults.get(prefix):
+            return None
+        members = self._members.get(prefix, {})
+        if not members:
+            return None
+        interface, ips = max(members.items(), key=lambda item: len(item[1]))
+        current = self._aggregated.get(prefix)
+        threshold = self._threshold()
+        # Split back only well below the threshold to avoid flapping
+        if current is not None and \
+                len(members.get(current, ())) >= threshold // 2:
+            interface = current
+        elif len(ips) < threshold:
+            return None
+        if self._covered_by_prefix_route(prefix, interface, prefix_cache):
+            return None
+        return interface
+
+    def aggregated_prefixes(self) -> list[int]:
+        return list(self._aggregated)
+
+    def rebalance(self, prefixes: Iterable[int],
+                  prefix_cache: dict[InterfaceConfig, set[str]]) \
+            -> list[list[str]]:
+        commands = []
+        for prefix in set(prefixes):
+            current = self._aggregated.get(prefix)
+            desired = self._desired(prefix, prefix_cache)
+            if current == desired:
+                continue
+            members = self._members.get(prefix, {})
+            network = self._network(prefix)
+            if current is not None:
+                commands += [['replace', ip, 'via', current.gateway_ip]
+                             for ip in sorted(members.get(current, ()))]
+                if desired is None:
+                    commands.append(['del', network])
+                del self._aggregated[prefix]
+            if desired is not None:
+                commands.append(['replace', network,
+                                 'via', desired.gateway_ip])
+                commands += [['del', ip]
+                             for ip in sorted(members.get(desired, ()))]
+                self._aggregated[prefix] = desired
+            logger.info(f'Aggregated route for {network}: '
+                        f'{current.name if current else "none"} -> '
+                        f'{desired.name if desired else "none"}')
+        return commands
+
+    def rebuild(self, cache: dict[InterfaceConfig, set[str]],
+                prefix_cache: dict[InterfaceConfig, set[str]]):
+        # Called after the route cache was rebuilt from the kernel. Member
+        # IPs of aggregated prefixes have no host routes there, so they are
+        # put back into the cache if the covering route is still in place
+        aggregated = {}
+        for prefix, interface in self._aggregated.items():
+            network = self._network(prefix)
+            if network in prefix_cache.get(interface, ()):
+                prefix_cache[interface].discard(network)
+                cache.setdefault(interface, set()).update(
+                    self._members.get(prefix, {}).get(interface, ()))
+                aggregated[prefix] = interface
+        self._aggregated = aggregated
+        self._expire_defaults()
+        self.index(cache)
+
+    def index(self, cache: dict[InterfaceConfig, set[str]]):
+        self._members = {}
+        for interface, ips in cache.items():
+            for ip in ips:
+                self.note_routed(interface, ip)
+
+    def dump(self) -> list:
+        return [[self._network(prefix), interface.name, interface.gateway_ip]
+                for prefix, interface in self._aggregated.items()]
+
+    def load(self, aggregated: list,
+             cache: dict[InterfaceConfig, set[str]]):
+        tunnels = {(config.name, config.gateway_ip): config
+                   for config in get_config().networking.tunnels}
+        for network, name, gateway_ip in aggregated:
+            interface = tunnels.get((name, gateway_ip))
+            network = IPv4Network(network)
+            if interface is not None and \
+                    network.prefixlen == self._prefix_length():
+                self._aggregated[self.prefix_of(
+                    str(network.network_address))] = interface
+        self.index(cache)
+
+    def get_stats(self):
+        return {
+            'aggregated_prefixes': len(self._aggregated),
+            'tracked_prefixes': len(self._members),
+            'default_prefixes': len(self._defaults),
+        }
+
+
+route_aggregator = RouteAggregator()
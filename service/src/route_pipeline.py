@@ -0,0 +1,45 @@
+import asyncio
+import itertools
+from typing import Awaitable, Callable, Optional
+
+from logger import logger
+
+# Routes a client is waiting for go before background re-routes
+PRIORITY_RESOLVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class RoutePipeline:
+    _queue: Optional[asyncio.PriorityQueue]
+
+    def __init__(self):
+        self._queue = None
+        self._counter = itertools.count()
+
+    def start(self) -> asyncio.Task:
+        self._queue = asyncio.PriorityQueue()
+        return asyncio.create_task(self._worker())
+
+    def submit(self, priority: int,
+               job: Callable[[], Awaitable[None]]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._counter), job, future))
+        return future
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _worker(self):
+        while True:
+            _, _, job, future = await self._queue.get()
+            try:
+                await job()
+            except Exception:  # noqa
+                logger.exception('Failed to apply routes')
+            finally:
+                if not future.done():
+                    future.set_result(None)
+                self._queue.task_done()
+
+
+route_pipeline = RoutePipeline()
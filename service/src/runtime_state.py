@@ -0,0 +1,108 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+from typing import Optional
+
+from answer_cache import answer_cache
+from config import get_config, ExternalDomainList
+from domain_lists import lists, recompile_patterns
+from domain_router import dump_routed_domains, load_routed_domains
+from ip_route import dump_cache, load_cache, dump_aggregated_routes
+from logger import logger
+from scheduler import scheduler
+
+SNAPSHOT_VERSION = 1
+
+
+def _get_boot_id() -> Optional[str]:
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _collect_state() -> dict:
+    return {
+        'version': SNAPSHOT_VERSION,
+        'saved_at': time.time(),
+        'boot_id': _get_boot_id(),
+        'answers': answer_cache.dump(asyncio.get_running_loop().time()),
+        'routed_domains': dump_routed_domains(),
+        'routes': dump_cache(),
+        'aggregated_routes': dump_aggregated_routes(),
+        'external_lists': {
+            list_config.name: [list_config.url, matcher.dump_state()]
+            for list_config, matcher in lists.items()
+            if isinstance(list_config, ExternalDomainList)
+        },
+    }
+
+
+def _write_snapshot(file_name: str, state: dict):
+    tmp_file_name = file_name + '.tmp'
+    with gzip.open(tmp_file_name, 'wt', compresslevel=1) as f:
+        json.dump(state, f, separators=(',', ':'))
+    os.replace(tmp_file_name, file_name)
+
+
+def _read_snapshot(file_name: str) -> Optional[dict]:
+    try:
+        with gzip.open(file_name, 'rt') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+async def save_snapshot():
+    file_name = get_config().state_snapshot.file
+    started_at = time.perf_counter()
+    state = _collect_state()
+    await asyncio.get_running_loop().run_in_executor(
+        None, _write_snapshot, file_name, state)
+    logger.info(f'Saved runtime state snapshot to {file_name} in '
+                f'{(time.perf_counter() - started_at) * 1000:.0f} ms')
+
+
+async def load_snapshot() -> bool:
+    snapshot_config = get_config().state_snapshot
+    try:
+        state = _read_snapshot(snapshot_config.file)
+    except (OSError, ValueError):
+        logger.exception(f'Failed to read snapshot {snapshot_config.file}')
+        return False
+    if state is None or state.get('version') != SNAPSHOT_VERSION:
+        return False
+    if time.time() - state['saved_at'] > \
+            snapshot_config.max_age_hours * 3600:
+        logger.info('Runtime state snapshot is too old, ignoring it')
+        return False
+
+    answer_cache.load(state['answers'], asyncio.get_running_loop().time())
+    load_routed_domains(state['routed_domains'])
+
+    # Routes do not survive a reboot. Otherwise trust the snapshot and let
+    # the periodic sync validate it later
+    routes_restored = state['boot_id'] == _get_boot_id()
+    if routes_restored:
+        load_cache(state['routes'], state.get('aggregated_routes', []))
+
+    external_lists = state['external_lists']
+    for list_config, matcher in lists.items():
+        url, prefixes = external_lists.get(list_config.name, (None, None))
+        if isinstance(list_config, ExternalDomainList) and \
+                url == list_config.url:
+            matcher.load_state(prefixes)
+    await recompile_patterns()
+
+    logger.info(f'Restored runtime state snapshot from '
+                f'{snapshot_config.file}')
+    return routes_restored
+
+
+def start_periodic_snapshots() -> asyncio.Task:
+    interval = get_config().state_snapshot.interval_minutes * 60
+    return scheduler.add('state_snapshot', save_snapshot, interval,
+                         initial_delay=interval)
@@ -0,0 +1,133 @@
+import asyncio
+import time
+from random import uniform
+from typing import Awaitable, Callable, Optional
+
+from config import get_config
+from logger import logger
+
+
+class ScheduledTask:
+    # A run never overlaps with another run of the same task: runs happen
+    # one after another in the task's loop, and a run requested while one
+    # is in progress is refused
+    name: str
+    interval: float
+    running: bool
+    failures: int
+    last_run: Optional[float]
+    last_duration: Optional[float]
+    last_status: Optional[str]
+    last_error: Optional[str]
+    next_run: Optional[float]
+
+    def __init__(self, name: str, func: Callable[[], Awaitable],
+                 interval: float):
+        self.name = name
+        self.interval = interval
+        self._func = func
+        self._wake = asyncio.Event()
+        self.running = False
+        self.failures = 0
+        self.last_run = None
+        self.last_duration = None
+        self.last_status = None
+        self.last_error = None
+        self.next_run = None
+
+    def _next_delay(self) -> float:
+        config = get_config().scheduler
+        delay = self.interval
+        if self.failures:
+            delay = min(delay, config.retry_seconds * 2 **
+                        (self.failures - 1))
+        return delay * (1 + uniform(-config.jitter_fraction,
+                                    config.jitter_fraction))
+
+    async def _run(self):
+        self.running = True
+        self.last_run = time.time()
+        start = time.monotonic()
+        try:
+            await self._func()
+            self.failures = 0
+            self.last_status = 'ok'
+            self.last_error = None
+        except Exception as e:  # noqa
+            self.failures += 1
+            self.last_status = 'failed'
+            self.last_error = repr(e)
+            logger.exception(f'Failed to execute scheduled task {self.name}')
+        finally:
+            self.running = False
+            self.last_duration = time.monotonic() - start
+
+    def _first_delay(self, initial_delay: float) -> float:
+        config = get_config().scheduler
+        return initial_delay + uniform(
+            0, min(self.interval * config.jitter_fraction,
+                   config.first_run_spread_seconds))
+
+    async def loop(self, initial_delay: float):
+        delay = self._first_delay(initial_delay)
+        while True:
+            self.next_run = time.time() + delay
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            self.next_run = None
+            await self._run()
+            delay = self._next_delay()
+
+    def run_now(self) -> bool:
+        if self.running:
+            return False
+        self._wake.set()
+        return True
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'interval': self.interval,
+            'running': self.running,
+            'failures': self.failures,
+            'last_run': self.last_run,
+            'last_duration': self.last_duration,
+            'last_status': self.last_status,
+            'last_error': self.last_error,
+            'next_run': self.next_run,
+        }
+
+
+class Scheduler:
+    _tasks: dict[str, tuple[ScheduledTask, asyncio.Task]]
+
+    def __init__(self):
+        self._tasks = {}
+
+    def add(self, name: str, func: Callable[[], Awaitable], interval: float,
+            initial_delay: float = 0) -> asyncio.Task:
+        self.remove(name)
+        task = ScheduledTask(name, func, interval)
+        loop_task = asyncio.create_task(task.loop(initial_delay))
+        self._tasks[name] = (task, loop_task)
+        return loop_task
+
+    def remove(self, name: str):
+        _, loop_task = self._tasks.pop(name, (None, None))
+        if loop_task is not None:
+            loop_task.cancel()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tasks
+
+    def run_now(self, name: str) -> bool:
+        return self._tasks[name][0].run_now()
+
+    def get_status(self) -> list:
+        return [task.as_dict() for task, _ in self._tasks.values()]
+
+
+scheduler = Scheduler()
@@ -0,0 +1,114 @@
+from ipaddress import ip_address, IPv4Address, IPv6Address
+from typing import Iterable, NamedTuple, Optional
+
+from aiodnsresolver import TYPES, IPv4AddressExpiresAt, IPv6AddressExpiresAt
+
+from config import get_config
+from logger import logger
+
+ZERO_ADDRESSES = {
+    TYPES.A: (IPv4Address('0.0.0.0'),),
+    TYPES.AAAA: (IPv6Address('::'),),
+}
+
+
+class StaticAnswer(NamedTuple):
+    ip_addresses: tuple
+    # Blocked names are answered, but never routed
+    blocked: bool
+    nxdomain: bool
+
+
+def _read_lines(file_name: str) -> Iterable[list[str]]:
+    try:
+        with open(file_name) as file:
+            for line in file:
+                fields = line.split('#', 1)[0].split()
+                if fields:
+                    yield fields
+    except OSError as e:
+        logger.warning(f'Failed to read {file_name}: {e}')
+
+
+class StaticAnswers:
+    # Both tables are keyed by the lowercased name, so a query costs one
+    # dict lookup
+    _records: dict[str, dict[int, tuple]]
+    _blocked: set[str]
+
+    def __init__(self):
+        self._records = {}
+        self._blocked = set()
+
+    def _add(self, records: dict[str, dict[int, tuple]], name: str,
+             address: str):
+        try:
+            parsed = ip_address(address)
+        except ValueError:
+            logger.debug(f'Skipping invalid address {address} for {name}')
+            return
+        qtype = TYPES.A if parsed.version == 4 else TYPES.AAAA
+        by_type = records.setdefault(name.lower().rstrip('.'), {})
+        if parsed not in by_type.get(qtype, ()):
+            by_type[qtype] = by_type.get(qtype, ()) + (parsed,)
+
+    def load(self) -> bool:
+        config = get_config().static_answers
+        records = {}
+        for name, addresses in config.records.items():
+            for address in addresses:
+                self._add(records, name, address)
+        for file_name in config.hosts_files:
+            for address, *names in _read_lines(file_name):
+                for name in names:
+                    self._add(records, name, address)
+
+        blocked = set()
+        for file_name in config.blocklist_files:
+            for fields in _read_lines(file_name):
+                # Either a bare name or a hosts line like "0.0.0.0 name"
+                names = fields[1:] if len(fields) > 1 else fields
+                blocked.update(name.lower().rstrip('.') for name in names)
+
+        changed = records != self._records or blocked != self._blocked
+        self._records = records
+        self._blocked = blocked
+        logger.info(f'Loaded {len(records)} static records and '
+                    f'{len(blocked)} blocked names')
+        return changed
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._records or name in self._blocked
+
+    def lookup(self, name: str, qtype: int, now: float) \
+            -> Optional[StaticAnswer]:
+        if name in self._blocked:
+            if get_config().static_answers.blocklist_mode == 'nxdomain':
+                return StaticAnswer((), blocked=True, nxdomain=True)
+            addresses = ZERO_ADDRESSES.get(qtype)
+            blocked = True
+        else:
+            by_type = self._records.get(name)
+            if by_type is None:
+                return None
+            addresses = by_type.get(qtype, ())
+            blocked = False
+        if addresses is None:
+            return None
+
+        expires_at = now + get_config().static_answers.ttl_seconds
+        address_type = IPv4AddressExpiresAt if qtype == TYPES.A else \
+            IPv6AddressExpiresAt
+        return StaticAnswer(
+            tuple(address_type(address.packed, expires_at)
+                  for address in addresses),
+            blocked=blocked, nxdomain=False)
+
+    def get_stats(self):
+        return {
+            'records': len(self._records),
+            'blocked': len(self._blocked),
+        }
+
+
+static_answers = StaticAnswers()
@@ -0,0 +1,177 @@
+import math
+import time
+from array import array
+from collections import deque
+from typing import Deque, Optional
+
+from config import get_config, TrafficStatsConfig
+from event_logger import event_logger, Event, ResolveEvent
+
+# Resolve events are counted into time buckets with fixed size sketches, so
+# memory depends only on the config, not on how many queries or distinct
+# names there are. Windows are answered by merging the buckets they cover.
+
+
+class SpaceSaving:
+    # Heavy hitters with at most capacity counters. A new item takes over
+    # the counter of the least frequent one, so its count may be too high
+    # by at most the inherited count, which is kept as the error. Items are
+    # also grouped by count, so the least frequent one is found without a
+    # scan
+    _counters: dict[str, list[int]]
+    _groups: dict[int, dict[str, None]]
+    _min_count: int
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._counters = {}
+        self._groups = {}
+        self._min_count = 0
+
+    def _unlink(self, item: str, count: int):
+        group = self._groups[count]
+        del group[item]
+        if not group:
+            del self._groups[count]
+
+    def add(self, item: str):
+        counter = self._counters.get(item)
+        if counter is not None:
+            self._unlink(item, counter[0])
+        elif len(self._counters) < self._capacity:
+            counter = self._counters[item] = [0, 0]
+        else:
+            victim = next(iter(self._groups[self._min_count]))
+            counter = self._counters.pop(victim)
+            self._unlink(victim, counter[0])
+            counter[1] = counter[0]
+            self._counters[item] = counter
+        counter[0] += 1
+        self._groups.setdefault(counter[0], {})[item] = None
+        if counter[0] == 1 or self._min_count not in self._groups:
+            self._min_count = counter[0]
+
+    def items(self):
+        return self._counters.items()
+
+
+class CountMinSketch:
+    # Estimated count of any item, never lower than the real one
+    _rows: list[array]
+
+    def __init__(self, width: int, depth: int):
+        self._width = width
+        self._rows = [array('L', [0]) * width for _ in range(depth)]
+
+    def _cells(self, item: str):
+        return ((row, hash((i, item)) % self._width)
+                for i, row in enumerate(self._rows))
+
+    def add(self, item: str):
+        for row, cell in self._cells(item):
+            row[cell] += 1
+
+    def estimate(self, item: str) -> int:
+        return min(row[cell] for row, cell in self._cells(item))
+
+
+class StatsBucket:
+    index: int
+    queries: int
+    routed: int
+    lists: dict[str, int]
+
+    def __init__(self, index: int, config: TrafficStatsConfig):
+        self.index = index
+        self.queries = 0
+        self.routed = 0
+        self.lists = {}
+        self.top_domains = SpaceSaving(config.top_capacity)
+        self.top_clients = SpaceSaving(config.top_capacity)
+        self.domains = CountMinSketch(config.sketch_width,
+                                      config.sketch_depth)
+        self.clients = CountMinSketch(config.sketch_width,
+                                      config.sketch_depth)
+
+
+def _merge_top(sketches, limit: int) -> list:
+    merged = {}
+    for sketch in sketches:
+        for item, (count, error) in sketch.items():
+            total = merged.setdefault(item, [0, 0])
+            total[0] += count
+            total[1] += error
+    top = sorted(merged.items(), key=lambda item: -item[1][0])[:limit]
+    return [{'name': item, 'count': count, 'error': error}
+            for item, (count, error) in top]
+
+
+class TrafficStats:
+    _buckets: Deque[StatsBucket]
+
+    def __init__(self):
+        self._buckets = deque()
+
+    def _current_bucket(self) -> StatsBucket:
+        config = get_config().traffic_stats
+        index = int(time.monotonic() // config.bucket_seconds)
+        if not self._buckets or self._buckets[-1].index != index:
+            self._buckets.append(StatsBucket(index, config))
+            while len(self._buckets) > config.buckets:
+                self._buckets.popleft()
+        return self._buckets[-1]
+
+    def on_event(self, event: Event):
+        if not isinstance(event, ResolveEvent):
+            return
+        bucket = self._current_bucket()
+        bucket.queries += 1
+        bucket.top_domains.add(event.domain)
+        bucket.domains.add(event.domain)
+        bucket.top_clients.add(event.remote)
+        bucket.clients.add(event.remote)
+        if event.domain_list is not None:
+            bucket.lists[event.domain_list] = \
+                bucket.lists.get(event.domain_list, 0) + 1
+            if event.domain_list != 'force_default':
+                bucket.routed += 1
+
+    def get_stats(self, window_seconds: float, limit: int,
+                  domain: Optional[str] = None,
+                  client: Optional[str] = None):
+        config = get_config().traffic_stats
+        first = int(time.monotonic() // config.bucket_seconds) - \
+            math.ceil(window_seconds / config.bucket_seconds) + 1
+        buckets = [bucket for bucket in self._buckets
+                   if bucket.index >= first]
+
+        lists = {}
+        for bucket in buckets:
+            for name, count in bucket.lists.items():
+                lists[name] = lists.get(name, 0) + count
+        queries = sum(bucket.queries for bucket in buckets)
+        routed = sum(bucket.routed for bucket in buckets)
+
+        stats = {
+            'window_seconds': min(window_seconds,
+                                  config.bucket_seconds * config.buckets),
+            'queries': queries,
+            'routed': routed,
+            'default': queries - routed,
+            'lists': lists,
+            'top_domains': _merge_top(
+                (bucket.top_domains for bucket in buckets), limit),
+            'top_clients': _merge_top(
+                (bucket.top_clients for bucket in buckets), limit),
+        }
+        if domain is not None:
+            stats['domain_count'] = sum(bucket.domains.estimate(domain)
+                                        for bucket in buckets)
+        if client is not None:
+            stats['client_count'] = sum(bucket.clients.estimate(client)
+                                        for bucket in buckets)
+        return stats
+
+
+traffic_stats = TrafficStats()
+event_logger.add_listener(traffic_stats.on_event)
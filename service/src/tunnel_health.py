@@ -0,0 +1,159 @@
+import asyncio
+import math
+import re
+from typing import Awaitable, Callable, Optional
+
+from config import get_config, InterfaceConfig, ProbeConfig, TunnelGroup
+from ip_route import exec_command
+from logger import logger
+from scheduler import scheduler
+
+# Returns round trip time in seconds, or None if the tunnel is unreachable
+Probe = Callable[[InterfaceConfig, ProbeConfig], Awaitable[Optional[float]]]
+SwitchListener = Callable[[TunnelGroup, str, str], Awaitable[None]]
+
+LATENCY_SMOOTHING = 0.3
+
+
+async def ping_probe(interface: InterfaceConfig,
+                     probe_config: ProbeConfig) -> Optional[float]:
+    output = await exec_command(
+        'ping', '-n', '-c', '1', '-I', interface.name,
+        '-W', str(math.ceil(probe_config.timeout_seconds)),
+        probe_config.target)
+    values = re.search(r'time=([\d.]+) ms', output)
+    return float(values.group(1)) / 1000 if values else None
+
+
+class TunnelState:
+    latency: Optional[float]
+    failures: int
+
+    def __init__(self):
+        self.latency = None
+        self.failures = 0
+
+    @property
+    def healthy(self):
+        probe_config = get_config().networking.probe
+        return self.failures < probe_config.failures_before_down
+
+    def update(self, latency: Optional[float]):
+        if latency is None:
+            self.failures += 1
+            return
+        self.failures = 0
+        self.latency = latency if self.latency is None else \
+            self.latency + LATENCY_SMOOTHING * (latency - self.latency)
+
+    def as_dict(self):
+        return {
+            'healthy': self.healthy,
+            'latency_ms': self.latency * 1000
+            if self.latency is not None else None,
+            'failures': self.failures,
+        }
+
+
+class TunnelHealth:
+    _states: dict[str, TunnelState]
+    _active: dict[str, str]
+    _listeners: list[SwitchListener]
+
+    def __init__(self, probe: Probe = ping_probe):
+        self._probe = probe
+        self._states = {}
+        self._active = {}
+        self._listeners = []
+
+    def set_probe(self, probe: Probe):
+        self._probe = probe
+
+    def add_listener(self, listener: SwitchListener):
+        self._listeners.append(listener)
+
+    def _get_state(self, tunnel_name: str) -> TunnelState:
+        state = self._states.get(tunnel_name)
+        if state is None:
+            state = self._states[tunnel_name] = TunnelState()
+        return state
+
+    @staticmethod
+    def _get_tunnels(group: TunnelGroup) -> list[str]:
+        # Members that are not configured tunnels are never selected
+        configured = {tunnel.name
+                      for tunnel in get_config().networking.tunnels}
+        return [name for name in group.tunnels if name in configured] or \
+            group.tunnels
+
+    def _select(self, group: TunnelGroup) -> str:
+        current = self._active.get(group.name)
+        tunnels = self._get_tunnels(group)
+        healthy = [name for name in tunnels
+                   if self._get_state(name).healthy]
+        if not healthy:
+            return current if current in tunnels else tunnels[0]
+
+        def latency(name):
+            value = self._get_state(name).latency
+            return value if value is not None else math.inf
+
+        best = min(healthy, key=latency)
+        # Only switch away from a healthy tunnel if the gain is noticeable,
+        # otherwise routes would flap between tunnels with similar latency
+        margin = get_config().networking.probe.switch_margin_ms / 1000
+        if current in healthy and latency(current) <= latency(best) + margin:
+            return current
+        return best
+
+    def get_active(self, group: TunnelGroup) -> str:
+        active = self._active.get(group.name)
+        if active is None or active not in self._get_tunnels(group):
+            active = self._active[group.name] = self._select(group)
+        return active
+
+    async def probe_all(self):
+        networking = get_config().networking
+        tunnels = {tunnel.name: tunnel for tunnel in networking.tunnels}
+        names = sorted({name for group in networking.tunnel_groups
+                        for name in group.tunnels if name in tunnels})
+        latencies = await asyncio.gather(
+            *(self._probe(tunnels[name], networking.probe) for name in names),
+            return_exceptions=True)
+        for name, latency in zip(names, latencies):
+            if isinstance(latency, Exception):
+                logger.info(f'Probe of tunnel {name} failed: {latency!r}')
+                latency = None
+            state = self._get_state(name)
+            was_healthy = state.healthy
+            state.update(latency)
+            if was_healthy != state.healthy:
+                logger.warning(f'Tunnel {name} is now '
+                               f'{"up" if state.healthy else "down"}')
+
+        for group in networking.tunnel_groups:
+            old = self.get_active(group)
+            new = self._select(group)
+            if new == old:
+                continue
+            logger.warning(f'Switching tunnel group {group.name} '
+                           f'from {old} to {new}')
+            self._active[group.name] = new
+            for listener in self._listeners:
+                await listener(group, old, new)
+
+    def get_status(self):
+        return {
+            'tunnels': {name: state.as_dict()
+                        for name, state in self._states.items()},
+            'groups': {group.name: self.get_active(group)
+                       for group in get_config().networking.tunnel_groups},
+        }
+
+
+tunnel_health = TunnelHealth()
+
+
+def start_tunnel_probing() -> asyncio.Task:
+    return scheduler.add('tunnel_probe', tunnel_health.probe_all,
+                         get_config().networking.probe.interval_seconds)
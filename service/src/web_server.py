@@ -1,16 +1,30 @@
 import asyncio
 import os
+import uuid
 
 from aiohttp import web
 from aiohttp.web_request import Request
 from aiohttp_sse import sse_response
 
+from answer_cache import answer_cache
 from config import get_config
-from domain_lists import get_manual_domain_lists, get_domain_matcher
+from config_reload import reload
+from dns_proxy import stats as dns_stats
+from domain_lists import get_manual_domain_lists, get_domain_matcher, \
+    get_match_cache_stats
 from domain_matchers import DomainMatcher
-from domain_router import re_route_domain
+from domain_router import re_route_list_entry
 from event_logger import event_logger
 from logger import logger
+from profiling import query_profiler, cpu_sampler, memory_profiler
+from query_trace import trace_writer
+from replication import get_replication_status
+from route_aggregation import route_aggregator
+from route_pipeline import route_pipeline
+from scheduler import scheduler
+from static_answers import static_answers
+from traffic_stats import traffic_stats
+from tunnel_health import tunnel_health
 
 
 class EventSourceHandler:
@@ -55,10 +69,57 @@ def get_matcher_by_name(name: str) -> DomainMatcher:
     return get_domain_matcher(domain_list)
 
 
+MAX_PAGE_SIZE = 1000
+# List generations start over in every process, so ETags also carry a value
+# unique to the process
+ETAG_NONCE = uuid.uuid4().hex[:8]
+STATIC_ASSETS_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
 async def get_domain_list_handler(request: Request):
     domain_list_name = request.match_info['domain_list']
     domain_matcher = get_matcher_by_name(domain_list_name)
-    return web.json_response(domain_matcher.get_all())
+    etag = f'"{ETAG_NONCE}-{domain_list_name}-{domain_matcher.generation}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if request.headers.get('If-None-Match') == etag:
+        raise web.HTTPNotModified(headers=headers)
+
+    index = await domain_matcher.get_index()
+    query = request.query
+    if not query.keys() & {'limit', 'cursor', 'prefix', 'q'}:
+        # Whole list, as the UI expects it
+        response = web.json_response(index.domains, headers=headers)
+    else:
+        try:
+            limit = min(int(query.get('limit', 100)), MAX_PAGE_SIZE)
+        except ValueError:
+            raise web.HTTPBadRequest(text='limit must be an integer')
+        if limit < 1:
+            raise web.HTTPBadRequest(text='limit must be positive')
+        if '\n' in query.get('q', ''):
+            raise web.HTTPBadRequest(text='q must not contain newlines')
+        items, has_more = index.page(
+            query.get('cursor'), limit,
+            prefix=query.get('prefix'), substring=query.get('q'))
+        response = web.json_response({
+            'items': items,
+            'next_cursor': items[-1] if has_more else None,
+            'total': len(index.domains),
+        }, headers=headers)
+    response.enable_compression(
+        web.ContentCoding.gzip
+        if 'gzip' in request.headers.get('Accept-Encoding', '') else None)
+    return response
+
+
+async def set_static_cache_headers(request: Request,
+                                   response: web.StreamResponse):
+    if request.path.startswith('/api/'):
+        return
+    # Bundled assets have content hashes in their names, index.html has not
+    response.headers['Cache-Control'] = \
+        STATIC_ASSETS_CACHE_CONTROL if request.path.startswith('/static/') \
+        else 'no-cache'
 
 
 async def add_domain_handler(request: Request):
@@ -66,7 +127,7 @@ async def add_domain_handler(request: Request):
     domain_matcher = get_matcher_by_name(domain_list_name)
     data = await request.json()
     await domain_matcher.add(data['domain'])
-    await re_route_domain(data['domain'])
+    await re_route_list_entry(data['domain'])
     return web.json_response('ok')
 
 
@@ -75,10 +136,113 @@ async def delete_domain_handler(request: Request):
     domain_matcher = get_matcher_by_name(domain_list_name)
     data = await request.json()
     await domain_matcher.remove(data['domain'])
-    await re_route_domain(data['domain'])
+    await re_route_list_entry(data['domain'])
     return web.json_response('ok')
 
 
+async def stats_handler(request: Request):
+    return web.json_response({
+        'dns': dns_stats,
+        'match_cache': get_match_cache_stats(),
+        'answer_cache': answer_cache.get_stats(),
+        'route_aggregation': route_aggregator.get_stats(),
+        'pending_route_jobs': route_pipeline.pending(),
+        'static_answers': static_answers.get_stats(),
+    })
+
+
+async def top_stats_handler(request: Request):
+    query = request.query
+    try:
+        window_seconds = float(query.get('window', 3600))
+        limit = min(int(query.get('limit', 20)), MAX_PAGE_SIZE)
+    except ValueError:
+        raise web.HTTPBadRequest(text='window and limit must be numbers')
+    return web.json_response(traffic_stats.get_stats(
+        window_seconds, limit,
+        domain=query.get('domain'), client=query.get('client')))
+
+
+async def tunnels_handler(request: Request):
+    return web.json_response(tunnel_health.get_status())
+
+
+async def reload_handler(request: Request):
+    try:
+        changes = await reload()
+    except Exception as e:  # noqa
+        raise web.HTTPBadRequest(text=f'Failed to reload config: {e}')
+    return web.json_response(changes)
+
+
+async def scheduler_tasks_handler(request: Request):
+    return web.json_response(scheduler.get_status())
+
+
+async def scheduler_run_handler(request: Request):
+    name = request.match_info['name']
+    if name not in scheduler:
+        raise web.HTTPNotFound()
+    if not scheduler.run_now(name):
+        raise web.HTTPConflict(text=f'Task {name} is already running')
+    return web.json_response({'name': name}, status=202)
+
+
+async def replication_status_handler(request: Request):
+    return web.json_response(get_replication_status())
+
+
+async def trace_status_handler(request: Request):
+    return web.json_response(trace_writer.get_status())
+
+
+async def trace_start_handler(request: Request):
+    trace_writer.start()
+    return web.json_response(trace_writer.get_status())
+
+
+async def trace_stop_handler(request: Request):
+    trace_writer.stop()
+    return web.json_response(trace_writer.get_status())
+
+
+async def profiling_stats_handler(request: Request):
+    return web.json_response({
+        'stages': query_profiler.get_stats(),
+        'slow_queries': query_profiler.get_slow_queries(),
+    })
+
+
+async def profiling_reset_handler(request: Request):
+    query_profiler.reset()
+    return web.json_response('ok')
+
+
+async def cpu_profiler_start_handler(request: Request):
+    cpu_sampler.start()
+    return web.json_response('ok')
+
+
+async def cpu_profiler_stop_handler(request: Request):
+    limit = int(request.query.get('limit', 30))
+    return web.json_response(cpu_sampler.stop(limit))
+
+
+async def memory_profiler_start_handler(request: Request):
+    memory_profiler.start()
+    return web.json_response('ok')
+
+
+async def memory_profiler_stop_handler(request: Request):
+    memory_profiler.stop()
+    return web.json_response('ok')
+
+
+async def memory_snapshot_handler(request: Request):
+    limit = int(request.query.get('limit', 30))
+    return web.json_response(memory_profiler.snapshot(limit))
+
+
 async def setup_web_server():
     app = web.Application()
     app.router.add_route('GET', '/api/event-log',
@@ -91,11 +255,40 @@ async def setup_web_server():
                          add_domain_handler)
     app.router.add_route('DELETE', '/api/domain-lists/{domain_list}',
                          delete_domain_handler)
+
+    app.router.add_route('GET', '/api/stats', stats_handler)
+    app.router.add_route('GET', '/api/stats/top', top_stats_handler)
+    app.router.add_route('GET', '/api/tunnels', tunnels_handler)
+    app.router.add_route('POST', '/api/reload', reload_handler)
+    app.router.add_route('GET', '/api/scheduler/tasks',
+                         scheduler_tasks_handler)
+    app.router.add_route('POST', '/api/scheduler/tasks/{name}/run',
+                         scheduler_run_handler)
+
+    app.router.add_route('GET', '/api/replication',
+                         replication_status_handler)
+    app.router.add_route('GET', '/api/trace', trace_status_handler)
+    app.router.add_route('POST', '/api/trace/start', trace_start_handler)
+    app.router.add_route('POST', '/api/trace/stop', trace_stop_handler)
+
+    app.router.add_route('GET', '/api/profiling', profiling_stats_handler)
+    app.router.add_route('DELETE', '/api/profiling', profiling_reset_handler)
+    app.router.add_route('POST', '/api/profiling/cpu/start',
+                         cpu_profiler_start_handler)
+    app.router.add_route('POST', '/api/profiling/cpu/stop',
+                         cpu_profiler_stop_handler)
+    app.router.add_route('POST', '/api/profiling/memory/start',
+                         memory_profiler_start_handler)
+    app.router.add_route('POST', '/api/profiling/memory/stop',
+                         memory_profiler_stop_handler)
+    app.router.add_route('GET', '/api/profiling/memory/snapshot',
+                         memory_snapshot_handler)
     for try_static in ['service/static', 'ui/build']:
         if os.path.isdir(try_static):
             app.router.add_route('GET', '/', lambda _: web.FileResponse(
                 os.path.join(try_static, 'index.html')))
             app.router.add_static('/', try_static, follow_symlinks=True)
+            app.on_response_prepare.append(set_static_cache_headers)
             break
 
     runner = web.AppRunner(app)